@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 import argparse
+import email.utils
+import glob
+import gzip
+import hashlib
 import http.server
 import json
+import mmap
 import os
+import re
 import shutil
 import ssl
 import subprocess
+import sys
+import threading
+import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process
-from time import sleep
-from watchdog.events import PatternMatchingEventHandler
+from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 srcdir = "src"
 outputdir = "dist"
 
@@ -23,78 +38,705 @@ def clean():
         pass
 
 
-def _copy(watch):
-    def do_copy(*args, **kwargs):
-        for (parent, _, files) in os.walk(srcdir):
-            outdir = parent.replace(srcdir, outputdir)
-            print("Creating", outdir)
+# Bound on the number of files hashed/copied concurrently
+copy_workers = min(32, (os.cpu_count() or 1) + 4)
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _kernel_copy(fsrc, fdst, size):
+    # Copy without bouncing the data through userspace, preferring
+    # copy_file_range (which can reflink on supporting filesystems) over
+    # sendfile.
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                sent = os.copy_file_range(fsrc, fdst, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except OSError:
+            if offset:
+                raise
+    try:
+        while offset < size:
+            sent = os.sendfile(fdst, fsrc, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except OSError:
+        if offset:
+            raise
+        with open(fsrc, "rb", closefd=False) as src:
+            with open(fdst, "wb", closefd=False) as dst:
+                shutil.copyfileobj(src, dst)
+
+
+def _transfer(srcfile, outputfile, link=True):
+    # Atomically replaces outputfile with the contents of srcfile. Returns the
+    # number of bytes written and whether a hardlink was used instead.
+    tmpfile = "{}.{}.tmp".format(outputfile, threading.get_ident())
+    same_dev = os.stat(srcfile).st_dev == os.stat(os.path.dirname(outputfile)).st_dev
+    if link and same_dev:
+        try:
+            os.link(srcfile, tmpfile)
+            os.replace(tmpfile, outputfile)
+            return 0, True
+        except OSError:
             try:
-                os.mkdir(outdir)
-            except FileExistsError:
+                os.remove(tmpfile)
+            except FileNotFoundError:
                 pass
 
-            for f in files:
-                srcfile = os.path.join(parent, f)
-                outputfile = os.path.join(outdir, f)
-                print(srcfile, "->", outputfile)
-                shutil.copy(srcfile, outputfile)
-
-    do_copy()
-    if watch:
-        handler = PatternMatchingEventHandler(ignore_patterns=["*.ts"])
-        handler.on_modified = do_copy
-        observer = Observer()
-        observer.schedule(handler, srcdir, recursive=True)
-        observer.start()
+    with open(srcfile, "rb") as fsrc, open(tmpfile, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        _kernel_copy(fsrc.fileno(), fdst.fileno(), size)
+    shutil.copymode(srcfile, tmpfile)
+    os.replace(tmpfile, outputfile)
+    return size, False
+
+
+# Incrementally mirrors srcdir into outputdir. A manifest of every copied
+# file's size, mtime and content hash is persisted in outputdir so that
+# unchanged files are skipped across runs. Only files recorded in the manifest
+# are ever removed, so webpack/sass output is left alone. Files are hardlinked
+# when possible unless `link` is off, which releases need: an in-place write to
+# src/ (an editor, prettier) would change a linked file in every build.
+class AssetSync:
+    def __init__(self, srcdir, outputdir, link=True):
+        self.srcdir = srcdir
+        self.outputdir = outputdir
+        self.link = link
+        self.manifest_path = os.path.join(outputdir, ".sync_manifest.json")
+        self.manifest = {}
         try:
-            while True:
-                sleep(1)
-        except:
-            observer.stop()
-        observer.join()
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def save(self):
+        os.makedirs(self.outputdir, exist_ok=True)
+        tmpfile = self.manifest_path + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmpfile, self.manifest_path)
+
+    def _remove(self, rel):
+        removed = []
+        prefix = rel + os.sep
+        for entry in list(self.manifest):
+            if entry == rel or entry.startswith(prefix):
+                del self.manifest[entry]
+                try:
+                    os.remove(os.path.join(self.outputdir, entry))
+                except FileNotFoundError:
+                    pass
+                removed.append(entry)
+        return removed
+
+    # Runs on the copy pool. Returns None if the output is already up to date,
+    # otherwise (manifest entry, bytes written, hardlinked).
+    def _sync_file(self, rel):
+        srcfile = os.path.join(self.srcdir, rel)
+        outputfile = os.path.join(self.outputdir, rel)
+        st = os.stat(srcfile)
+
+        entry = self.manifest.get(rel)
+        digest = None
+        if not self.link and os.path.exists(outputfile):
+            if os.path.samestat(os.stat(outputfile), st):
+                # Linked by an earlier build
+                entry = None
+        if entry and os.path.exists(outputfile):
+            if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+                return None
+            # Touched but possibly unchanged (e.g. git checkout), only copy if
+            # the contents actually differ.
+            digest = _hash_file(srcfile)
+            if digest == entry["hash"]:
+                entry["mtime"] = st.st_mtime_ns
+                return None
+
+        if digest is None:
+            digest = _hash_file(srcfile)
+        os.makedirs(os.path.dirname(outputfile), exist_ok=True)
+        nbytes, linked = _transfer(srcfile, outputfile, self.link)
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "hash": digest}
+        return entry, nbytes, linked
+
+    def _sync_files(self, rels):
+        if len(rels) > 1:
+            with ThreadPoolExecutor(max_workers=copy_workers) as executor:
+                results = list(executor.map(self._sync_file, rels))
+        else:
+            results = [self._sync_file(rel) for rel in rels]
+
+        copied = []
+        stats = {"bytes": 0, "linked": 0}
+        for rel, result in zip(rels, results):
+            if result is None:
+                continue
+            entry, nbytes, linked = result
+            self.manifest[rel] = entry
+            copied.append(rel)
+            stats["bytes"] += nbytes
+            stats["linked"] += linked
+        return copied, stats
+
+    def _report(self, copied, removed, stats, start):
+        elapsed = (time.monotonic() - start) * 1000
+        print(
+            f"Synced {self.srcdir} -> {self.outputdir}: {len(copied)} copied "
+            f"({stats['bytes']} bytes, {stats['linked']} hardlinked), "
+            f"{len(removed)} removed in {elapsed:.0f}ms"
+        )
+
+    def _walk(self, rel):
+        for (parent, _, files) in os.walk(os.path.join(self.srcdir, rel)):
+            for f in files:
+                yield os.path.relpath(os.path.join(parent, f), self.srcdir)
+
+    def sync_all(self):
+        start = time.monotonic()
+        rels = list(self._walk(""))
+        copied, stats = self._sync_files(rels)
+
+        seen = set(rels)
+        removed = []
+        for rel in list(self.manifest):
+            if rel not in seen:
+                removed += self._remove(rel)
+        self.save()
+        self._report(copied, removed, stats, start)
+        return copied, removed
 
+    def sync_paths(self, paths):
+        # Sync only the given source paths (as reported by watchdog) without
+        # walking the rest of the tree.
+        start = time.monotonic()
+        rels = []
+        removed = []
+        for path in paths:
+            rel = os.path.relpath(path, self.srcdir)
+            if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+                continue
+            srcpath = os.path.join(self.srcdir, rel)
+            if os.path.isdir(srcpath):
+                rels += self._walk(rel)
+            elif os.path.exists(srcpath):
+                rels.append(rel)
+            else:
+                removed += self._remove(rel)
+        copied, stats = self._sync_files(list(dict.fromkeys(rels)))
+        if copied or removed:
+            self.save()
+            self._report(copied, removed, stats, start)
+        return copied, removed
 
-def copy(watch):
-    # TODO use watch
-    proc = Process(target=_copy, args=(watch,))
+
+def _copy(link):
+    AssetSync(srcdir, outputdir, link).sync_all()
+
+
+def copy(link=True):
+    proc = Process(target=_copy, args=(link,))
     proc.start()
     return proc
 
 
-def build(watch, release):
+def build(release, watch=False):
     p = subprocess.Popen(
-        ["webpack", "--env.production={}".format(json.dumps(release))]
+        [
+            "webpack",
+            "--env.production={}".format(json.dumps(release)),
+            "--output-path",
+            outputdir,
+        ]
         + (["--watch"] if watch else [])
     )
     return p
 
 
-def sass(watch):
+def sass():
     srcfile = os.path.join(srcdir, "stylesheets/style.scss")
     dstfile = os.path.join(outputdir, "style.css")
-    p = subprocess.Popen(["sass", srcfile, dstfile] + (["--watch"] if watch else []))
+    p = subprocess.Popen(["sass", srcfile, dstfile])
     return p
 
 
+# Events that change what's in srcdir
+rebuild_events = {"created", "modified", "deleted", "moved"}
+
+
+# Collects filesystem events from a single observer on srcdir, coalesces them
+# until no new event has arrived for `debounce` seconds and then runs every
+# stage that the batch touches. Batches are processed one at a time, so a stage
+# is never built twice concurrently; events that arrive while a batch is being
+# built are coalesced into the next one.
+class RebuildScheduler(FileSystemEventHandler):
+    # `external` matches paths that something else rebuilds on its own, the
+    # batch can't tell when that's done
+    def __init__(self, stages, debounce, external=None):
+        super().__init__()
+        self.stages = stages
+        self.debounce = debounce
+        self.external = external
+        self.cond = threading.Condition()
+        self.pending = []
+        self.first_event = None
+        self.last_event = None
+
+    def on_any_event(self, event):
+        # Newer watchdog also reports files being opened and closed, which the
+        # stages themselves do when they read src/
+        if event.event_type not in rebuild_events:
+            return
+        # Changes to a directory's listing are reported per file as well
+        if event.is_directory and event.event_type == "modified":
+            return
+        paths = [event.src_path]
+        if getattr(event, "dest_path", None):
+            paths.append(event.dest_path)
+
+        with self.cond:
+            now = time.monotonic()
+            if not self.pending:
+                self.first_event = now
+            self.last_event = now
+            self.pending += paths
+            self.cond.notify()
+
+    def _next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            while True:
+                remaining = self.last_event + self.debounce - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            paths = list(dict.fromkeys(self.pending))
+            self.pending = []
+            return paths, self.first_event
+
+    def _run_batch(self, paths, first_event):
+        routed = []
+        for name, matches, run in self.stages:
+            stage_paths = [p for p in paths if matches(p)]
+            if stage_paths:
+                routed.append((name, run, stage_paths))
+        external = None
+        if self.external and any(self.external[1](p) for p in paths):
+            external = self.external[0]
+        if not routed:
+            if external:
+                print(f"[watch] {len(paths)} path(s) -> left to {external}")
+            return
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(routed)) as executor:
+            futures = [
+                (name, executor.submit(run, stage_paths))
+                for name, run, stage_paths in routed
+            ]
+            for name, future in futures:
+                try:
+                    if future.result() is False:
+                        failed.append(name)
+                except Exception as e:
+                    print(f"[watch] {name} raised {e!r}")
+                    failed.append(name)
+
+        latency = (time.monotonic() - first_event) * 1000
+        stage_names = ", ".join(name for name, _, _ in routed)
+        if failed:
+            status = f"FAILED ({', '.join(failed)})"
+        elif external:
+            status = f"done, {external} may still be writing"
+        else:
+            status = "dist is consistent"
+        print(
+            f"[watch] {len(paths)} path(s) -> {stage_names}: {status} "
+            f"after {latency:.0f}ms"
+        )
+
+    def run_forever(self):
+        observer = Observer()
+        observer.schedule(self, srcdir, recursive=True)
+        observer.start()
+        try:
+            while True:
+                self._run_batch(*self._next_batch())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            observer.stop()
+            observer.join()
+
+
+def _has_ext(*exts):
+    return lambda path: path.endswith(exts)
+
+
+def _watch(release, debounce):
+    sync = AssetSync(srcdir, outputdir)
+
+    def copy_stage(paths):
+        sync.sync_paths(paths)
+
+    def sass_stage(_paths):
+        return sass().wait() == 0
+
+    # TypeScript is only bundled, by webpack's own watcher
+    stages = [
+        ("copy", lambda path: not path.endswith((".ts", ".tsx")), copy_stage),
+        ("sass", _has_ext(".scss"), sass_stage),
+    ]
+
+    # Bring dist up to date before reacting to events. webpack keeps running
+    # and rebuilds incrementally, it never writes anything the stages read.
+    sync.sync_all()
+    sass_proc = sass()
+    build_proc = build(release, watch=True)
+    sass_proc.wait()
+
+    external = ("webpack --watch", _has_ext(".ts", ".tsx", ".json"))
+    try:
+        RebuildScheduler(stages, debounce, external).run_forever()
+    finally:
+        build_proc.terminate()
+        build_proc.wait()
+
+
+def watch(release, debounce):
+    proc = Process(target=_watch, args=(release, debounce))
+    proc.start()
+    return proc
+
+
+# Release builds give these files content-hashed names so they can be cached
+# forever. The order matters: references to a file are only rewritten in the
+# files that come after it.
+release_hashed = [
+    "assets/*",
+    "ext_scripts/jsstore.worker.min.js",
+    "style.css",
+    "index.js",
+]
+# Entry points that keep their name, with their references rewritten
+release_pages = ["index.html"]
+release_text = (".html", ".css", ".js", ".json", ".svg")
+release_compress = release_text + (".ico",)
+release_manifest = "manifest.json"
+hash_length = 10
+# Names of files produced by hash_for_release
+_hashed_name = re.compile(r"\.[0-9a-f]{%d}\.[^.]+$" % hash_length)
+
+
+def _write_atomic(path, data):
+    # Never write through an existing file, it may be hardlinked to src/
+    tmpfile = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(tmpfile, "wb") as f:
+        f.write(data)
+    os.replace(tmpfile, path)
+
+
+def _compress(path, data):
+    # Precompressed siblings that the server (or a CDN) can send as is
+    outputs = [(".gz", gzip.compress(data, 9, mtime=0))]
+    if brotli:
+        outputs.append((".br", brotli.compress(data)))
+    for suffix, compressed in outputs:
+        if len(compressed) < len(data):
+            _write_atomic(path + suffix, compressed)
+
+
+def _remove_release(manifest):
+    for hashed in manifest.values():
+        for suffix in ["", ".gz", ".br"]:
+            try:
+                os.remove(os.path.join(outputdir, hashed + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def hash_for_release():
+    manifest_path = os.path.join(outputdir, release_manifest)
+    try:
+        with open(manifest_path) as f:
+            _remove_release(json.load(f))
+    except (FileNotFoundError, ValueError):
+        pass
+
+    def rewrite(rel, data):
+        if not rel.endswith(release_text):
+            return data
+        for original, hashed in manifest.items():
+            data = data.replace(f"./{original}".encode(), f"./{hashed}".encode())
+        return data
+
+    manifest = OrderedDict()
+    for pattern in release_hashed:
+        for path in sorted(glob.glob(os.path.join(outputdir, pattern))):
+            rel = os.path.relpath(path, outputdir)
+            if _hashed_name.search(rel) or rel.endswith((".gz", ".br")):
+                # Left over from a release without a manifest
+                continue
+            with open(path, "rb") as f:
+                data = rewrite(rel, f.read())
+            base, ext = os.path.splitext(rel)
+            digest = hashlib.sha256(data).hexdigest()[:hash_length]
+            hashed = f"{base}.{digest}{ext}"
+            _write_atomic(os.path.join(outputdir, hashed), data)
+            if rel.endswith(release_compress):
+                _compress(os.path.join(outputdir, hashed), data)
+            manifest[rel] = hashed
+
+    for rel in release_pages:
+        # From src/ since the copy in dist/ may be a rewritten one
+        with open(os.path.join(srcdir, rel), "rb") as f:
+            data = rewrite(rel, f.read())
+        # Not precompressed: a later development build would leave a stale
+        # sibling behind
+        _write_atomic(os.path.join(outputdir, rel), data)
+
+    # The rewritten pages no longer match src/, make the next copy restore them
+    sync = AssetSync(srcdir, outputdir)
+    for rel in release_pages:
+        sync.manifest.pop(rel, None)
+    sync.save()
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    print(f"Hashed {len(manifest)} release file(s)")
+    if brotli is None:
+        print("brotli is not installed, only .gz siblings were written")
+    return manifest
+
+
 def prep_for_release():
-    shutil.rmtree(os.path.join(outputdir, "test"))
+    shutil.rmtree(os.path.join(outputdir, "test"), ignore_errors=True)
+    hash_for_release()
+
+
+# Response body handed from send_head to copyfile. The data is either bytes or
+# a memoryview over an mmap, so it is written to the socket without copying.
+class CachedBody:
+    def __init__(self, data):
+        self.data = data
+
+    def close(self):
+        pass
 
 
-def serve(dir_, port):
+# Byte-budgeted LRU of file contents shared by all server threads. Files are
+# read into memory, except large content-hashed ones which are memory-mapped.
+# Entries are validated against (inode, size, mtime) on every lookup, so files
+# rewritten by the copy stage or webpack are picked up without any explicit
+# invalidation.
+class FileCache:
+    def __init__(self, budget, mmap_threshold=256 << 10):
+        self.budget = budget
+        self.mmap_threshold = mmap_threshold
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load(self, path):
+        with open(path, "rb") as f:
+            fs = os.fstat(f.fileno())
+            # webpack and sass truncate and rewrite their output in place,
+            # which would SIGBUS a response reading from a mapping. Only
+            # content-hashed files are mapped, they are written once through
+            # a rename and never change.
+            hashed = _hashed_name.search(os.path.basename(path))
+            if fs.st_size < self.mmap_threshold or not hashed:
+                data = f.read()
+            else:
+                # The mapping outlives the file object; it is unmapped once
+                # the last response referencing it is done.
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return data, fs
+
+    def get(self, path):
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == key:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return CachedBody(entry[1]), entry[2]
+            self.misses += 1
+
+        data, fs = self._load(path)
+        key = (fs.st_ino, fs.st_size, fs.st_mtime_ns)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old:
+                self.size -= len(old[1])
+            if len(data) <= self.budget:
+                self.entries[path] = (key, data, fs)
+                self.size += len(data)
+                while self.size > self.budget:
+                    _, (_, evicted, _) = self.entries.popitem(last=False)
+                    self.size -= len(evicted)
+                    self.evictions += 1
+        return CachedBody(data), fs
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+
+class StaticRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 lets browsers reuse the TLS connection for every asset
+    protocol_version = "HTTP/1.1"
+    # Precompressed siblings in order of preference
+    encodings = [("br", ".br"), ("gzip", ".gz")]
+
+    def _accepted_encodings(self):
+        accepted = set()
+        for token in self.headers.get("Accept-Encoding", "").split(","):
+            parts = token.strip().split(";")
+            if parts[1:] and parts[1].strip() in ("q=0", "q=0.0"):
+                continue
+            accepted.add(parts[0].strip())
+        return accepted
+
+    def _negotiate(self, path):
+        accepted = self._accepted_encodings()
+        for encoding, suffix in self.encodings:
+            if encoding in accepted and os.path.isfile(path + suffix):
+                return path + suffix, encoding
+        return path, None
+
+    def _is_fresh(self, etag, mtime):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(",")]
+            return "*" in tags or etag in tags or ("W/" + etag) in tags
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not self.path.split("?", 1)[0].endswith("/"):
+                # Let the base class issue the redirect/listing
+                return super().send_head()
+            index = os.path.join(path, "index.html")
+            if not os.path.isfile(index):
+                return super().send_head()
+            path = index
+
+        ctype = self.guess_type(path)
+        served, encoding = self._negotiate(path)
+        try:
+            body, fs = self.server.cache.get(served)
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        etag = '"{:x}-{:x}{}"'.format(
+            fs.st_size, fs.st_mtime_ns, "-" + encoding if encoding else ""
+        )
+        fresh = self._is_fresh(etag, fs.st_mtime)
+        self.send_response(
+            http.HTTPStatus.NOT_MODIFIED if fresh else http.HTTPStatus.OK
+        )
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        if _hashed_name.search(os.path.basename(path)):
+            # The name changes with the contents
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        else:
+            self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if fresh:
+            self.end_headers()
+            return None
+
+        self.send_header("Content-Type", ctype)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body.data)))
+        self.end_headers()
+        return body
+
+    def copyfile(self, source, outputfile):
+        if isinstance(source, CachedBody):
+            outputfile.write(source.data)
+        else:
+            super().copyfile(source, outputfile)
+
+    def do_GET(self):
+        if self.path == "/__cache_stats":
+            body = json.dumps(self.server.cache.stats()).encode()
+            self.send_response(http.HTTPStatus.OK)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        super().do_GET()
+
+
+class StaticServer(http.server.ThreadingHTTPServer):
+    # Keep-alive connections each hold a thread, so don't let them block exit
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler, cache_size):
+        super().__init__(server_address, handler)
+        self.cache = FileCache(cache_size)
+
+
+def serve(dir_, port, cache_size):
     if dir_:
         os.chdir(dir_)
     if port is None:
         port = 4443
     server_address = ("0.0.0.0", port)
-    httpd = http.server.HTTPServer(server_address, http.server.SimpleHTTPRequestHandler)
-    httpd.socket = ssl.wrap_socket(
-        httpd.socket,
-        server_side=True,
-        certfile="localhost.pem",
-        ssl_version=ssl.PROTOCOL_TLSv1_2,
+    httpd = StaticServer(server_address, StaticRequestHandler, cache_size << 20)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain("localhost.pem")
+    # Defer the handshake to the per-connection thread so that one slow
+    # client can't stall accept()
+    httpd.socket = context.wrap_socket(
+        httpd.socket, server_side=True, do_handshake_on_connect=False
     )
     print(f"Now serving at: https://localhost:{port}")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        print("File cache:", json.dumps(httpd.cache.stats()))
 
 
 def lint():
@@ -104,17 +746,36 @@ def lint():
 
 
 def main():
+    global outputdir
     parser = argparse.ArgumentParser(description="build")
     parser.add_argument("-c", "--clean", action="store_true")
     parser.add_argument("-d", "--dir", type=str)
+    parser.add_argument(
+        "-o", "--output", default=outputdir, help="directory to build into"
+    )
     parser.add_argument("-l", "--lint", action="store_true")
     parser.add_argument("-p", "--port", type=int)
     parser.add_argument("-r", "--release", action="store_true")
     parser.add_argument("-s", "--serve", action="store_true")
     parser.add_argument("-w", "--watch", action="store_true")
     parser.add_argument("--no-build", action="store_true")
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="megabytes of file contents the server keeps cached",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=int,
+        default=100,
+        help="milliseconds of quiet to wait for before rebuilding in watch mode",
+    )
 
     args = parser.parse_args()
+    # Before any stage is forked off, they all read it
+    outputdir = args.output
+
     if args.lint:
         lint()
 
@@ -124,20 +785,30 @@ def main():
     sass_proc = None
     build_proc = None
     copy_proc = None
+    watch_proc = None
     if not args.no_build:
-        copy_proc = copy(args.watch)
-        sass_proc = sass(args.watch)
-        build_proc = build(args.watch, args.release)
+        if args.watch:
+            watch_proc = watch(args.release, args.debounce / 1000)
+        else:
+            # Releases must not share files with src/
+            copy_proc = copy(link=not args.release)
+            sass_proc = sass()
+            build_proc = build(args.release)
 
     if args.serve:
-        serve_proc = Process(target=serve, args=(args.dir, args.port))
+        serve_proc = Process(target=serve, args=(args.dir, args.port, args.cache_size))
         serve_proc.start()
         serve_proc.join()
 
-    if not args.no_build:
+    if watch_proc:
+        watch_proc.join()
+    elif not args.no_build:
         copy_proc.join()
         sass_proc.wait()
         build_proc.wait()
+        # Don't let a deploy publish a half built dist/
+        if copy_proc.exitcode or sass_proc.returncode or build_proc.returncode:
+            sys.exit(1)
 
     if args.release:
         prep_for_release()
@@ -0,0 +1,120 @@
+import { PostDescriptor } from "./post";
+
+// Serialized form of a BloomFilter, as sent in a QueryPostMessage. This relies
+// on peerjs's binarypack serialization, which keeps `bits` as raw bytes (they
+// arrive as an ArrayBuffer); JSON would turn them into a plain object.
+export interface BloomFilterData {
+    bits: Uint8Array | ArrayBuffer | number[];
+    // In bits, a multiple of 8
+    size: number;
+    hashes: number;
+    seed: number;
+}
+
+// More probes than any sensible false positive rate needs
+const maxHashes = 64;
+
+// 32 bit FNV-1a
+function fnv1a(key: string, seed: number): number {
+    let h = (0x811c9dc5 ^ seed) >>> 0;
+    for (let i = 0; i < key.length; i++) {
+        h ^= key.charCodeAt(i);
+        h = Math.imul(h, 0x01000193);
+    }
+    return h >>> 0;
+}
+
+export class BloomFilter {
+    bits: Uint8Array;
+    hashes: number;
+    seed: number;
+
+    constructor(size: number, hashes: number, seed: number = 0) {
+        this.bits = new Uint8Array(Math.max(1, Math.ceil(size / 8)));
+        this.hashes = hashes;
+        this.seed = seed >>> 0;
+    }
+
+    // Smallest filter that holds `count` keys with the given false positive
+    // rate
+    static forCapacity(
+        count: number,
+        falsePositiveRate: number,
+        seed: number = 0
+    ): BloomFilter {
+        const n = Math.max(1, count);
+        const size = Math.ceil(
+            (-n * Math.log(falsePositiveRate)) / (Math.LN2 * Math.LN2)
+        );
+        const hashes = Math.max(1, Math.round((size / n) * Math.LN2));
+        return new BloomFilter(size, hashes, seed);
+    }
+
+    // Null if `data` isn't a well formed filter, e.g. bits that went through
+    // a serialization that doesn't keep binary data, which would otherwise
+    // read as an empty filter
+    static fromData(data: BloomFilterData): BloomFilter | null {
+        if (!data) return null;
+        const { bits, size, hashes, seed } = data;
+        const binary =
+            bits instanceof Uint8Array ||
+            bits instanceof ArrayBuffer ||
+            Array.isArray(bits);
+        if (!binary) return null;
+        if (!Number.isInteger(size) || size <= 0 || size % 8 != 0) return null;
+        if (!Number.isInteger(hashes) || hashes < 1 || hashes > maxHashes)
+            return null;
+        if (!Number.isInteger(seed)) return null;
+
+        const bytes = new Uint8Array(bits as ArrayBuffer);
+        if (bytes.length * 8 != size) return null;
+        const filter = new BloomFilter(0, hashes, seed);
+        filter.bits = bytes;
+        return filter;
+    }
+
+    toData(): BloomFilterData {
+        return {
+            bits: this.bits,
+            size: this.size,
+            hashes: this.hashes,
+            seed: this.seed,
+        };
+    }
+
+    get size(): number {
+        return this.bits.length * 8;
+    }
+
+    // Double hashing, the i-th probe is h1 + i * h2
+    private probe(key: string, f: (bit: number) => boolean): boolean {
+        const h1 = fnv1a(key, this.seed);
+        const h2 = fnv1a(key, h1) | 1;
+        const size = this.size;
+        for (let i = 0; i < this.hashes; i++) {
+            const bit = (h1 + Math.imul(i, h2)) >>> 0;
+            if (!f(bit % size)) return false;
+        }
+        return true;
+    }
+
+    add(key: string) {
+        this.probe(key, (bit: number) => {
+            this.bits[bit >> 3] |= 1 << (bit & 7);
+            return true;
+        });
+    }
+
+    has(key: string): boolean {
+        return this.probe(
+            key,
+            (bit: number) => (this.bits[bit >> 3] & (1 << (bit & 7))) != 0
+        );
+    }
+}
+
+// Posts are identified by id and timestamp, so an updated post doesn't match
+// the filter of a peer that only has the old version
+export function descriptorKey(desc: PostDescriptor): string {
+    return `${desc.id}:${desc.timestamp}`;
+}
@@ -1,6 +1,7 @@
 import Peer from "peerjs";
 
 import * as Msg from "./messages";
+import { BloomFilter, descriptorKey } from "./bloom";
 import { UIElements } from "./ui";
 import * as CryptoLib from "./crypto";
 import {
@@ -13,6 +14,7 @@ import {
     Post,
     PostDescriptor,
     PostDBInterface,
+    PostRange,
     PostVerificationState,
 } from "./post";
 import { Storages } from "./storage";
@@ -22,6 +24,8 @@ interface Connection {
     conn: any;
     open: boolean;
     time: number;
+    // Whether a post query covering the whole cache was sent on it
+    synced: boolean;
 }
 
 export type ConnectionMap = Map<string, Connection>;
@@ -146,9 +150,7 @@ export class Client {
         });
 
         function queryPosts() {
-            // TODO use a random stream pick k elements algorithm instead of querying
-            // all conns
-            that.broadcast(new Msg.QueryPostMessage());
+            that.queryPosts();
         }
         this.setInterval(queryPosts, this.settings.intervals.queryposts);
 
@@ -162,8 +164,8 @@ export class Client {
             that.refreshConnections();
         }, this.settings.intervals.refreshconnections);
         this.setInterval(() => {
-            that.unverifiedPostCache.prune();
-            that.postCache.prune();
+            that.unverifiedPostCache.prune(that.settings.cachettl);
+            that.postCache.prune(that.settings.cachettl);
         }, this.settings.intervals.prunecache);
     }
 
@@ -262,15 +264,98 @@ export class Client {
         await this.addPost(post, false, null);
     }
 
+    // Number of queryposts ticks so far
+    postQueryTicks = 0;
+    async queryPosts() {
+        // TODO use a random stream pick k elements algorithm instead of querying
+        // all conns
+        const config = this.settings.postquery;
+        if (!config.filter) {
+            this.broadcast(new Msg.QueryPostMessage());
+            return;
+        }
+
+        // Connections that haven't had a query for the whole cache yet get
+        // one, the others only ask for recent posts. Every `fullsync` ticks
+        // all connections get a full query to pick up posts that were missed
+        // because of a false positive or that have an old timestamp.
+        const fullSync = this.postQueryTicks++ % config.fullsync == 0;
+        const full: Set<string> = new Set();
+        const recent: Set<string> = new Set();
+        this.connectionsMap.forEach((channel, peer) => {
+            if (!channel.open) return;
+            if (fullSync || !channel.synced) full.add(peer);
+            else recent.add(peer);
+            channel.synced = true;
+        });
+
+        const others = (peers: Set<string>) =>
+            new Set(
+                Array.from(this.connectionsMap.keys()).filter(
+                    (peer) => !peers.has(peer)
+                )
+            );
+        if (recent.size) {
+            const since = new Date().getTime() - config.window;
+            this.broadcast(await this.buildPostQuery(since), others(recent));
+        }
+        if (full.size)
+            this.broadcast(await this.buildPostQuery(), others(full));
+    }
+
+    // Query for the posts with a timestamp of at least `since` that aren't in
+    // either cache
+    async buildPostQuery(since?: number): Promise<Msg.QueryPostMessage> {
+        const range = since === undefined ? null : { since: since };
+        const descriptors = [
+            ...(await this.postCache.getAllPostDescriptors(null, range)),
+            ...(await this.unverifiedPostCache.getAllPostDescriptors(
+                null,
+                range
+            )),
+        ];
+        // A new seed every time so that a false positive doesn't hide the same
+        // post from every query
+        const filter = BloomFilter.forCapacity(
+            descriptors.length,
+            this.settings.postquery.falsepositive,
+            Math.random() * 0x100000000
+        );
+        descriptors.forEach((desc) => filter.add(descriptorKey(desc)));
+        return new Msg.QueryPostMessage(since, undefined, filter.toData());
+    }
+
     // TODO this map is never pruned
     postQueryTimers: Map<string, Date> = new Map();
-    async recvPostQuery(conn: any) {
+    async recvPostQuery(conn: any, query: any) {
+        let range: PostRange | null = null;
+        if (query.since !== undefined || query.until !== undefined)
+            range = { since: query.since, until: query.until };
+
+        // A malformed filter gets the plain answer below
+        const filter = query.filter ? BloomFilter.fromData(query.filter) : null;
+        if (filter) {
+            // Only send the posts in the range that the querier doesn't have.
+            // The answer doesn't depend on earlier ones, so postQueryTimers
+            // isn't used.
+            const descriptors = await this.postCache.getAllPostDescriptors(
+                null,
+                range
+            );
+            const missing = descriptors.filter(
+                (desc) => !filter.has(descriptorKey(desc))
+            );
+            conn.send(new Msg.QueryPostRespMessage(missing));
+            return;
+        }
+
         // Only send new postids that were added to the cache more recently than
         // the last time we responded to QueryPost on this connection.
         const lastRespTime = this.postQueryTimers.get(conn.peer) || null;
 
         const cachedIds = await this.postCache.getAllPostDescriptors(
-            lastRespTime
+            lastRespTime,
+            range
         );
         conn.send(new Msg.QueryPostRespMessage(cachedIds));
 
@@ -367,7 +452,7 @@ export class Client {
         if (data.type == Msg.MessageTypes.POST) {
             await this.recvPost(data);
         } else if (data.type == Msg.MessageTypes.QUERYPOSTS) {
-            this.recvPostQuery(conn);
+            this.recvPostQuery(conn, data);
         } else if (data.type == Msg.MessageTypes.QUERYPOSTSRESP) {
             this.recvPostQueryResp(conn, data);
         } else if (data.type == Msg.MessageTypes.REQUESTPOSTS) {
@@ -418,6 +503,7 @@ export class Client {
             conn: conn,
             open: false,
             time: new Date().getTime(),
+            synced: false,
         });
         this.ui.updateConnectionsUI();
 
@@ -1,3 +1,4 @@
+import { BloomFilterData } from "./bloom";
 import { Identity } from "./identity";
 import { Post, PostDescriptor } from "./post";
 
@@ -29,7 +30,21 @@ export class PostMessage extends Message {
 
 export class QueryPostMessage extends Message {
     type = MessageTypes.QUERYPOSTS;
-    // TODO include start range and end range
+    // All optional, a query without them asks for everything added since the
+    // last response on this connection.
+    // Only posts with since <= timestamp <= until
+    since?: number;
+    until?: number;
+    // Posts (see descriptorKey) the querier already has in the range, only
+    // the missing ones are sent back
+    filter?: BloomFilterData;
+
+    constructor(since?: number, until?: number, filter?: BloomFilterData) {
+        super();
+        if (since !== undefined) this.since = since;
+        if (until !== undefined) this.until = until;
+        if (filter) this.filter = filter;
+    }
 }
 
 export class QueryPostRespMessage extends Message {
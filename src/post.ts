@@ -15,6 +15,19 @@ export interface PostDescriptor {
     timestamp: number;
 }
 
+// Inclusive range of post timestamps, open ended if either end is missing
+export interface PostRange {
+    since?: number;
+    until?: number;
+}
+
+export function inRange(timestamp: number, range?: PostRange | null) {
+    if (!range) return true;
+    if (range.since !== undefined && timestamp < range.since) return false;
+    if (range.until !== undefined && timestamp > range.until) return false;
+    return true;
+}
+
 export class Post {
     author: Id.Identity = new Id.Identity();
     contents: string = "";
@@ -152,10 +165,13 @@ export const UnverifiedPostDBSchema: JsStore.ITable = {
 export interface PostDBInterface extends Db.DatabaseInterface {
     add: (post: Post) => Promise<boolean>;
     remove: (postid: string) => Promise<void>;
-    prune: () => Promise<void>;
+    prune: (ttl?: number) => Promise<void>;
     has: (id: string) => Promise<PostDescriptor | null>;
     get: (id: string) => Promise<Post>;
-    getAllPostDescriptors: (after?: Date | null) => Promise<PostDescriptor[]>;
+    getAllPostDescriptors: (
+        after?: Date | null,
+        range?: PostRange | null
+    ) => Promise<PostDescriptor[]>;
 }
 
 export class Database extends Db.Database implements PostDBInterface {
@@ -163,7 +179,7 @@ export class Database extends Db.Database implements PostDBInterface {
     schemas: JsStore.ITable[] = [PostDBSchema, UnverifiedPostDBSchema];
     suffix: string = "postCache";
     // TODO also enforce a max/min number of entries in the cache
-    // TODO get TTL from settings.json
+    // Default for prune, the client passes settings.cachettl
     TTL = 1 * 60 * 60 * 1000;
 
     async add(post: Post): Promise<boolean> {
@@ -195,12 +211,14 @@ export class Database extends Db.Database implements PostDBInterface {
         });
     }
 
-    async prune(): Promise<void> {
+    async prune(ttl?: number): Promise<void> {
         // TODO Should posts made by the self user have a longer or infinite
         // TTL?
         const expiryTime = new Date();
         // go back TTL ms
-        expiryTime.setTime(expiryTime.getTime() - this.TTL);
+        expiryTime.setTime(
+            expiryTime.getTime() - (ttl === undefined ? this.TTL : ttl)
+        );
 
         this.conn.remove({
             from: this.postCache,
@@ -237,16 +255,30 @@ export class Database extends Db.Database implements PostDBInterface {
     }
 
     async getAllPostDescriptors(
-        after?: Date | null
+        after?: Date | null,
+        range?: PostRange | null
     ): Promise<PostDescriptor[]> {
         const postIds = [];
 
         // TODO figure out how to access the SelectQuery type from JsStore
         const selector: any = { from: this.postCache };
+        const where: any = {};
         if (after) {
             // Only select posts added after the provided time
-            selector.where = { addedTime: { ">": after } };
+            where.addedTime = { ">": after };
+        }
+        if (range) {
+            where.timestamp = {
+                "-": {
+                    low: range.since === undefined ? 0 : range.since,
+                    high:
+                        range.until === undefined
+                            ? Number.MAX_SAFE_INTEGER
+                            : range.until,
+                },
+            };
         }
+        if (Object.keys(where).length) selector.where = where;
         const posts = await this.conn.select(selector);
 
         for (let post_ of posts) {
@@ -3,11 +3,33 @@ import * as dev_settings from "./settings_dev.json";
 
 export type Settings = typeof prod_settings;
 
+// `base` with the values in `overrides`, objects are merged key by key
+export function mergeSettings(base: Settings, overrides: any): Settings {
+    const merged = { ...base };
+    Object.keys(overrides).forEach((key_) => {
+        const key = key_ as keyof Settings;
+        if (typeof merged[key] === "object") {
+            merged[key] = {
+                ...(merged[key] as object),
+                ...(overrides[key] as object),
+            } as any;
+        } else {
+            merged[key] = overrides[key];
+        }
+    });
+    return merged;
+}
+
 let _settings: Settings | null = null;
 if (process.env.NODE_ENV === "production") {
     _settings = prod_settings;
 } else {
     _settings = dev_settings;
+    // Set by the test harness (see installSettingsOverride in
+    // test/lib/driver.py) to point a build at its own servers
+    const overrides =
+        typeof window !== "undefined" && (window as any).settingsOverride;
+    if (overrides) _settings = mergeSettings(_settings, overrides);
 }
 
 const settings: Settings = _settings!;
@@ -0,0 +1,5 @@
+// The serializer peerjs uses for data channel messages, it ships no types
+declare module "peerjs-js-binarypack" {
+    export function pack(data: any): Blob;
+    export function unpack(data: ArrayBuffer): any;
+}
@@ -47,3 +47,58 @@ export class TestSuite {
         this.sleep(interval);
     }
 }
+
+// Samples are logged as "[BENCH] <json>" for the python runner to collect
+export class BenchSuite extends TestSuite {
+    iterations: number = 50;
+    warmup: number = 5;
+
+    async measure(
+        name: string,
+        f: (i: number) => Promise<any>,
+        iterations?: number
+    ) {
+        const count = iterations || this.iterations;
+        for (let i = 0; i < Math.min(this.warmup, count); i++) await f(i);
+
+        const samples: number[] = [];
+        for (let i = 0; i < count; i++) {
+            const start = performance.now();
+            await f(i);
+            samples.push(performance.now() - start);
+        }
+        console.log(
+            "[BENCH] " +
+                JSON.stringify({
+                    name: name,
+                    // milliseconds
+                    samples: samples.map((s) => Math.round(s * 1000) / 1000),
+                })
+        );
+    }
+
+    async run() {
+        const prototype = Object.getPrototypeOf(this);
+        const properties = Object.getOwnPropertyNames(prototype);
+        const benches = properties.filter((n: string) => {
+            return (
+                n.startsWith("bench") && typeof (this as any)[n] === "function"
+            );
+        });
+        let failures = 0;
+        for (const bench of benches) {
+            console.group(bench);
+            try {
+                await (this as any)[bench].bind(this)();
+                console.log("[TEST] SUCCESS");
+            } catch (e) {
+                console.log(e);
+                failures += 1;
+                console.log("[TEST] FAILED");
+            }
+            console.groupEnd();
+        }
+        if (failures == 0) console.log("[SUITE] SUCCESS");
+        else console.log("[SUITE] FAILED");
+    }
+}
@@ -1,13 +1,16 @@
+import * as BinaryPack from "peerjs-js-binarypack";
 import * as JsStore from "jsstore";
 
-import * as settings from "../settings/settings_dev.json";
-import { Settings } from "../settings/settings";
+import settings, { mergeSettings, Settings } from "../settings/settings";
 import { Client } from "../client";
 import { UIElements, UIElementsArgs } from "../ui";
 import { IdentityTypes } from "../identity";
-import { TestSuite } from "./testLib";
+import { BenchSuite, TestSuite } from "./testLib";
+import * as Bloom from "../bloom";
+import * as CryptoLib from "../crypto";
 import * as Db from "../db";
 import * as Id from "../identity";
+import * as Msg from "../messages";
 import * as Post from "../post";
 import { loadPubKey } from "../crypto";
 
@@ -185,9 +188,13 @@ class MockPostDBBase implements Post.PostDBInterface {
         return this.entries.get(id)!;
     }
 
-    async getAllPostDescriptors(): Promise<Post.PostDescriptor[]> {
+    async getAllPostDescriptors(
+        _after?: Date | null,
+        range?: Post.PostRange | null
+    ): Promise<Post.PostDescriptor[]> {
         const descriptors: Post.PostDescriptor[] = [];
         this.entries.forEach((post, id) => {
+            if (!Post.inRange(post.desc.timestamp, range)) return;
             descriptors.push({
                 id: id,
                 timestamp: post.desc.timestamp,
@@ -225,18 +232,7 @@ function newMockedClient(
     name: string,
     idmgmt: IdentityTypes
 ): MockedClient {
-    const finalSettings = { ...settings };
-    Object.keys(newSettings).forEach((key_) => {
-        const key = key_ as keyof Settings;
-        if (typeof finalSettings[key] === "object") {
-            finalSettings[key] = {
-                ...(finalSettings[key] as object),
-                ...(newSettings[key] as object),
-            } as any;
-        } else {
-            finalSettings[key] = newSettings[key];
-        }
-    });
+    const finalSettings = mergeSettings(settings, newSettings);
 
     console.log("settings:", JSON.stringify(finalSettings));
 
@@ -322,6 +318,7 @@ async function withMockedClients(
 
 document.addEventListener("DOMContentLoaded", () => {
     (window as any).test = {
+        BinaryPack: BinaryPack,
         JsStore: JsStore,
         Db: Db,
         Client: Client,
@@ -331,5 +328,11 @@ document.addEventListener("DOMContentLoaded", () => {
         newMockedClient: newMockedClient,
         withMockedClients: withMockedClients,
         TestSuite: TestSuite,
+        BenchSuite: BenchSuite,
+        Bloom: Bloom,
+        CryptoLib: CryptoLib,
+        Id: Id,
+        Msg: Msg,
+        Post: Post,
     };
 });
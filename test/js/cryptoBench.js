@@ -0,0 +1,33 @@
+const contents = "a post about %benchmarks ".repeat(10);
+
+class Bench extends test.BenchSuite {
+    async benchSignVerify() {
+        const keys = await test.CryptoLib.generateKeys();
+        let signature = null;
+        await this.measure("crypto.sign", async () => {
+            signature = await test.CryptoLib.sign(contents, keys.privateKey);
+        });
+        await this.measure("crypto.verify", async () => {
+            const valid = await test.CryptoLib.verify(contents, signature, keys.publicKey);
+            this.assert(valid, "signature did not verify");
+        });
+    }
+
+    async benchHash() {
+        await this.measure("crypto.hash", async () => {
+            await test.CryptoLib.hash(contents);
+        });
+    }
+
+    async benchPostInitialize() {
+        const keys = await test.CryptoLib.generateKeys();
+        const ident = new test.Id.Identity();
+        ident.initialize("bench", "benchid");
+        await this.measure("post.initialize", async (i) => {
+            const post = new test.Post.Post(ident, contents + i);
+            await post.initialize(keys.privateKey);
+        });
+    }
+}
+
+(new Bench()).run();
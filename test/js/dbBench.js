@@ -0,0 +1,42 @@
+const count = 200;
+
+class Bench extends test.BenchSuite {
+    async benchPostDB() {
+        const ident = new test.Id.Identity();
+        ident.initialize("bench", "benchid");
+        const posts = [];
+        for (let i = 0; i < count; i++) {
+            const post = new test.Post.Post(ident, `post ${i}`);
+            await post.initialize(null);
+            posts.push(post);
+        }
+
+        const worker = new Worker("/dist/ext_scripts/jsstore.worker.min.js");
+        const conn = new test.JsStore.Connection(worker);
+        const db = new test.Post.PostDB(new test.Post.Database(conn, `bench${Date.now()}`));
+        await db.initialize();
+        try {
+            // No warmup, every post can only be added once
+            this.warmup = 0;
+            await this.measure("postdb.add", async (i) => {
+                await db.add(posts[i]);
+            }, count);
+            this.warmup = 5;
+            await this.measure("postdb.has", async (i) => {
+                this.assert(await db.has(posts[i % count].desc.id), "missing post");
+            }, count);
+            await this.measure("postdb.get", async (i) => {
+                await db.get(posts[i % count].desc.id);
+            }, count);
+            await this.measure("postdb.getAllPostDescriptors", async () => {
+                const descs = await db.getAllPostDescriptors();
+                this.assert(descs.length == count, descs.length);
+            });
+        } finally {
+            await conn.dropDb();
+            conn.terminate();
+        }
+    }
+}
+
+(new Bench()).run();
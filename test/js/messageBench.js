@@ -0,0 +1,35 @@
+const count = 100;
+
+// peerjs sends data channel messages with its binarypack serialization
+const BinaryPack = test.BinaryPack;
+
+class Bench extends test.BenchSuite {
+    async benchSerialize() {
+        const keys = await test.CryptoLib.generateKeys();
+        const ident = new test.Id.Identity();
+        ident.initialize("bench", "benchid");
+        const post = new test.Post.Post(ident, "a post about %benchmarks ".repeat(10));
+        await post.initialize(keys.privateKey);
+
+        const descs = [];
+        for (let i = 0; i < count; i++)
+            descs.push({id: `${post.desc.id}${i}`, timestamp: post.desc.timestamp + i});
+
+        const messages = {
+            post: new test.Msg.PostMessage(post),
+            querypostsresp: new test.Msg.QueryPostRespMessage(descs),
+        };
+        for (const [name, msg] of Object.entries(messages)) {
+            await this.measure(`json.${name}`, async () => {
+                JSON.parse(JSON.stringify(msg));
+            });
+            await this.measure(`binarypack.${name}`, async () => {
+                const blob = BinaryPack.pack(msg);
+                const buffer = await blob.arrayBuffer();
+                BinaryPack.unpack(buffer);
+            });
+        }
+    }
+}
+
+(new Bench()).run();
@@ -0,0 +1,85 @@
+// Compares answering QUERYPOSTS with every descriptor (what a peer sends on a
+// new connection without a filter) against a Bloom filter query, with 10k
+// posts cached and 1% of them missing at the querier
+const count = 10000;
+const missing = 100;
+
+// Bytes on the wire: peerjs sends data channel messages with its binarypack
+// serialization, which keeps the filter's Uint8Array as raw bytes
+function messageSize(msg) {
+    return test.BinaryPack.pack(msg).size;
+}
+
+// Just enough of a post cache for the client's query methods
+class DescriptorDB {
+    constructor(descriptors) {
+        this.descriptors = descriptors;
+    }
+
+    async getAllPostDescriptors(_after, range) {
+        return this.descriptors.filter((d) => test.Post.inRange(d.timestamp, range));
+    }
+}
+
+function peer(descriptors) {
+    return {
+        settings: test.settings,
+        postCache: new DescriptorDB(descriptors),
+        unverifiedPostCache: new DescriptorDB([]),
+        postQueryTimers: new Map(),
+    };
+}
+
+class Bench extends test.BenchSuite {
+    async benchPostQuery() {
+        this.iterations = 20;
+        const start = Date.now() - 60 * 60 * 1000;
+        const descriptors = [];
+        for (let i = 0; i < count; i++) {
+            const hash = (i * 2654435761 >>> 0).toString(32).padStart(52, "0");
+            const timestamp = start + i * 300;
+            descriptors.push({
+                id: `bench@benchid:[${timestamp}]${hash}`,
+                timestamp: timestamp,
+            });
+        }
+        const responder = peer(descriptors);
+        const querier = peer(descriptors.slice(missing));
+        const client = test.Client.prototype;
+
+        let response = null;
+        const conn = {peer: "querier", send: (msg) => { response = msg; }};
+
+        await this.measure("postquery.legacy", async () => {
+            responder.postQueryTimers.clear();
+            await client.recvPostQuery.call(responder, conn, new test.Msg.QueryPostMessage());
+        });
+        this.assert(response.posts.length == count, response.posts.length);
+        const legacyBytes = messageSize(response);
+
+        let query = null;
+        await this.measure("postquery.filter.build", async () => {
+            query = await client.buildPostQuery.call(querier);
+        });
+        await this.measure("postquery.filter.respond", async () => {
+            await client.recvPostQuery.call(responder, conn, query);
+        });
+        // Bloom filters have no false negatives, but false positives hide a
+        // few of the missing posts
+        this.assert(response.posts.length <= missing, response.posts.length);
+        this.assert(response.posts.length >= missing * 0.9, response.posts.length);
+        const filterBytes = messageSize(query) + messageSize(response);
+
+        // Bits that went through JSON come out as an object, which must not be
+        // read as an empty filter
+        const mangled = JSON.parse(JSON.stringify(query.filter));
+        this.assert(test.Bloom.BloomFilter.fromData(mangled) === null, "JSON filter accepted");
+
+        console.log(
+            `postquery bytes with ${count} posts: legacy ${legacyBytes}, ` +
+            `filter ${filterBytes} (${response.posts.length} descriptors sent)`
+        );
+    }
+}
+
+(new Bench()).run();
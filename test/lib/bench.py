@@ -0,0 +1,90 @@
+import fcntl
+import json
+import math
+import os
+
+# Benchmarks log "[BENCH] {name, samples}" from the test page (see BenchSuite
+# in src/test/testLib.ts). Results are compared with a baseline recorded on the
+# same machine (timings don't carry over between machines, so none is checked
+# in) and fail if the median got slower by more than the threshold. Benchmarks
+# missing from the baseline are only reported.
+baseline_file = "test/bench_baseline.json"
+# Allowed slowdown of the median relative to the baseline
+threshold = float(os.environ.get("BENCH_THRESHOLD", "0.25"))
+# Set to record the current results as the new baseline instead of comparing
+update_baseline = bool(os.environ.get("BENCH_UPDATE_BASELINE"))
+
+_marker = '"[BENCH] '
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def parse_sample(log):
+    # Console messages look like `<url> <line>:<col> "<string literal>"`
+    start = log["message"].find(_marker)
+    if start < 0:
+        return None
+    message = json.loads(log["message"][start:])
+    return json.loads(message[len(_marker) - 1 :])
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(samples, 50),
+        "p99": percentile(samples, 99),
+    }
+
+
+def _load_baseline():
+    try:
+        with open(baseline_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def check(suite, results):
+    # `results` maps benchmark names to summaries. Prints a report and raises
+    # if any benchmark regressed past the threshold.
+    with open(baseline_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        baseline = _load_baseline()
+        if update_baseline:
+            baseline[suite] = results
+            with open(baseline_file, "w") as f:
+                json.dump(baseline, f, indent=4, sort_keys=True)
+                f.write("\n")
+    expected = baseline.get(suite, {})
+
+    regressions = []
+    print(f"{'benchmark':<36} {'mean':>9} {'p50':>9} {'p99':>9} {'vs base':>8}")
+    for name, stats in sorted(results.items()):
+        change = ""
+        base = expected.get(name)
+        if base and base["p50"]:
+            ratio = stats["p50"] / base["p50"] - 1
+            change = f"{ratio * 100:+.0f}%"
+            if ratio > threshold and not update_baseline:
+                regressions.append(f"{name}: p50 {change}")
+        print(
+            f"{name:<36} {stats['mean']:>7.3f}ms {stats['p50']:>7.3f}ms "
+            f"{stats['p99']:>7.3f}ms {change:>8}"
+        )
+    if update_baseline:
+        print(f"Updated {baseline_file}")
+    elif not expected:
+        print(f"No baseline for {suite}, run with BENCH_UPDATE_BASELINE=1 to save one")
+
+    if regressions:
+        raise AssertionError(
+            f"Regressed by more than {threshold * 100:.0f}%: " + ", ".join(regressions)
+        )
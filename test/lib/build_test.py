@@ -0,0 +1,183 @@
+import functools
+import gzip
+import http.client
+import json
+import os
+import re
+import sys
+import threading
+
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+
+# build.py lives at the top of the repo, which the tests run from
+sys.path.insert(0, os.getcwd())
+import build
+
+test_config = {"rebuild_required": False, "server_required": False}
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_asset_sync(_testInput):
+    with TemporaryDirectory() as tempdir:
+        src = os.path.join(tempdir, "src")
+        dist = os.path.join(tempdir, "dist")
+        write(os.path.join(src, "index.html"), "<head></head>")
+        write(os.path.join(src, "assets/logo.svg"), "<svg/>")
+
+        copied, removed = build.AssetSync(src, dist).sync_all()
+        assert sorted(copied) == ["assets/logo.svg", "index.html"], copied
+        # Nothing changed, nothing to do, also for a fresh AssetSync that only
+        # has the manifest
+        assert build.AssetSync(src, dist).sync_all() == ([], [])
+
+        # Replaced like an editor would, not written through the hardlink
+        os.remove(os.path.join(src, "index.html"))
+        write(os.path.join(src, "index.html"), "<head><title/></head>")
+        os.remove(os.path.join(src, "assets/logo.svg"))
+        copied, removed = build.AssetSync(src, dist).sync_all()
+        assert copied == ["index.html"], copied
+        assert removed == ["assets/logo.svg"], removed
+        assert read(os.path.join(dist, "index.html")) == "<head><title/></head>"
+        assert not os.path.exists(os.path.join(dist, "assets/logo.svg"))
+
+        # Releases get copies, so later edits to src/ can't reach them
+        copied, _ = build.AssetSync(src, dist, link=False).sync_all()
+        assert copied == ["index.html"], copied
+        src_stat = os.stat(os.path.join(src, "index.html"))
+        assert not os.path.samestat(os.stat(os.path.join(dist, "index.html")), src_stat)
+
+
+@contextmanager
+def static_server(directory, cache_size=1 << 20):
+    handler = functools.partial(build.StaticRequestHandler, directory=directory)
+    httpd = build.StaticServer(("localhost", 0), handler, cache_size)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield httpd.server_address[1]
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def get(port, path, headers={}):
+    conn = http.client.HTTPConnection("localhost", port, timeout=5)
+    try:
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        return resp.status, dict(resp.getheaders()), resp.read()
+    finally:
+        conn.close()
+
+
+def test_static_server(_testInput):
+    with TemporaryDirectory() as tempdir:
+        data = b"console.log('hello');\n" * 100
+        with open(os.path.join(tempdir, "index.js"), "wb") as f:
+            f.write(data)
+        with open(os.path.join(tempdir, "index.js.gz"), "wb") as f:
+            f.write(gzip.compress(data))
+
+        with static_server(tempdir) as port:
+            status, headers, body = get(port, "/index.js")
+            assert status == 200 and body == data, status
+            assert "Content-Encoding" not in headers, headers
+
+            status, _, _ = get(port, "/index.js", {"If-None-Match": headers["ETag"]})
+            assert status == 304, status
+
+            accepts = {"Accept-Encoding": "gzip, br"}
+            status, headers, body = get(port, "/index.js", accepts)
+            assert headers["Content-Encoding"] == "gzip", headers
+            assert gzip.decompress(body) == data
+            refuses = {"Accept-Encoding": "gzip;q=0, identity"}
+            status, headers, body = get(port, "/index.js", refuses)
+            assert "Content-Encoding" not in headers and body == data, headers
+
+
+def test_file_cache(_testInput):
+    with TemporaryDirectory() as tempdir:
+        paths = []
+        for name in ["a.js", "b.js", "c.js"]:
+            paths.append(os.path.join(tempdir, name))
+            write(paths[-1], name * 100)
+        cache = build.FileCache(budget=800, mmap_threshold=1 << 20)
+        a, b, c = paths
+
+        cache.get(a)
+        cache.get(b)
+        cache.get(a)
+        # Over budget, b is the least recently used
+        cache.get(c)
+        stats = cache.stats()
+        assert stats["hits"] == 1 and stats["misses"] == 3, stats
+        assert stats["evictions"] == 1 and stats["bytes"] <= 800, stats
+        assert list(cache.entries) == [a, c], list(cache.entries)
+
+        # Rewritten files are read again
+        write(a, "changed")
+        body, _ = cache.get(a)
+        assert bytes(body.data) == b"changed"
+
+        # Only content-hashed files, which are never rewritten, are mapped
+        hashed = os.path.join(tempdir, "d.0123456789.js")
+        write(hashed, "d" * 300)
+        write(os.path.join(tempdir, "d.js"), "d" * 300)
+        cache = build.FileCache(budget=1 << 20, mmap_threshold=100)
+        body, _ = cache.get(hashed)
+        assert isinstance(body.data, memoryview), type(body.data)
+        body, _ = cache.get(os.path.join(tempdir, "d.js"))
+        assert isinstance(body.data, bytes), type(body.data)
+
+
+def test_hash_for_release(_testInput):
+    with TemporaryDirectory() as tempdir:
+        src = os.path.join(tempdir, "src")
+        dist = os.path.join(tempdir, "dist")
+        page = '<link href="./style.css" /><script src="./index.js"></script>'
+        write(os.path.join(src, "index.html"), page)
+        build.AssetSync(src, dist).sync_all()
+        write(os.path.join(dist, "style.css"), "a { b: url(./assets/logo.svg); }")
+        write(os.path.join(dist, "index.js"), "console.log('hello');")
+        write(os.path.join(dist, "assets/logo.svg"), "<svg/>")
+
+        old = build.srcdir, build.outputdir
+        build.srcdir, build.outputdir = src, dist
+        try:
+            manifest = build.hash_for_release()
+            with open(os.path.join(dist, build.release_manifest)) as f:
+                assert json.load(f) == manifest
+            assert sorted(manifest) == ["assets/logo.svg", "index.js", "style.css"]
+
+            index = read(os.path.join(dist, "index.html"))
+            references = re.findall(r'(?:src|href)="\./([^"]+)"', index)
+            assert references == [manifest["style.css"], manifest["index.js"]]
+            style = read(os.path.join(dist, manifest["style.css"]))
+            assert f"./{manifest['assets/logo.svg']}" in style, style
+            for hashed in manifest.values():
+                assert os.path.isfile(os.path.join(dist, hashed)), hashed
+
+            # A changed file gets a new name and the old one is removed
+            write(os.path.join(dist, "index.js"), "console.log('bye');")
+            rehashed = build.hash_for_release()
+            assert rehashed["index.js"] != manifest["index.js"]
+            assert not os.path.exists(os.path.join(dist, manifest["index.js"]))
+            assert rehashed["index.js"] in read(os.path.join(dist, "index.html"))
+
+            # The next development build restores the page from src/
+            copied, _ = build.AssetSync(src, dist).sync_all()
+            assert copied == ["index.html"], copied
+            assert read(os.path.join(dist, "index.html")) == page
+        finally:
+            build.srcdir, build.outputdir = old
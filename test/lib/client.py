@@ -1,8 +1,18 @@
+import atexit
+import threading
+import time
+
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.common.keys import Keys
-from time import sleep
+from selenium.webdriver.support.wait import WebDriverWait
+
+import profiling
+
+from waits import wait_for_dom, wait_until
 
 
 def _make_post(finder, parent, contents):
@@ -17,65 +27,119 @@ def _make_post(finder, parent, contents):
     editor.find_element_by_tag_name("textarea").send_keys("\n")
 
 
+# Scrapes every rendered post in one round trip. Only a post's own contents and
+# author are read, not those of its replies.
+_snapshot_script = """
+const posts = [];
+for (const el of document.querySelectorAll(".post")) {
+    const parent = el.parentElement;
+    const contents = el.querySelector(":scope > .post-contents");
+    const author = el.querySelector(":scope > .post-author");
+    posts.push({
+        id: el.id,
+        parent: parent.classList.contains("post") ? parent.id : null,
+        toplevel: parent.id === "posts",
+        contents: contents ? contents.innerText.trim() : "",
+        // The title always holds the expanded name@id
+        author: author ? author.title : "",
+    });
+}
+return posts;
+"""
+
+
+class PostSnapshot:
+    def __init__(self, driver):
+        self.driver = driver
+        self.refresh()
+
+    def refresh(self):
+        nodes = self.driver.execute_script(_snapshot_script)
+        self.nodes = dict()
+        self.children = dict()
+        self.toplevel = []
+        for node in nodes:
+            self.nodes[node["id"]] = node
+            self.children.setdefault(node["id"], [])
+            if node["parent"]:
+                self.children.setdefault(node["parent"], []).append(node["id"])
+            if node["toplevel"]:
+                self.toplevel.append(node["id"])
+        self.stale = False
+
+    def node(self, postid):
+        if self.stale:
+            self.refresh()
+        return self.nodes[postid]
+
+    def childIds(self, postid):
+        if self.stale:
+            self.refresh()
+        return self.children.get(postid, [])
+
+
 class Post:
-    def __init__(self, element):
-        self.element = element
+    # Reads come from a shared PostSnapshot; the live element is only looked
+    # up when interacting with the post.
+    def __init__(self, snapshot, postid):
+        self.snapshot = snapshot
+        self.postid = postid
 
     @property
-    def postid(self):
-        return self.element.get_attribute("id")
+    def element(self):
+        return self.snapshot.driver.execute_script(
+            "return document.getElementById(arguments[0])", self.postid
+        )
 
     @property
     def contents(self):
-        return self.element.find_element_by_class_name("post-contents").text
+        return self.snapshot.node(self.postid)["contents"]
 
     @property
     def author(self):
-        author_el = self.element.find_element_by_class_name("post-author")
-        author = author_el.text
-        if "@" not in author:
-            author_el.click()
-            author = author_el.text
-            assert "@" in author
-        assert author[-1] == ":"
-        return author[:-1]
+        return self.snapshot.node(self.postid)["author"]
 
     @property
     def children(self):
-        children = []
-        for child in self.element.find_elements_by_class_name("post"):
-            # Only consider children, not grandchildren
-            if child.find_element_by_xpath("./..") != self.element:
-                continue
-            children.append(Post(child))
-        return children
+        return [Post(self.snapshot, c) for c in self.snapshot.childIds(self.postid)]
 
     def reply(self, contents):
+        element = self.element
         reply_btn = None
-        for btn in self.element.find_elements_by_tag_name("a"):
+        for btn in element.find_elements_by_tag_name("a"):
             if btn.text == "Reply":
                 reply_btn = btn
         assert reply_btn
         reply_btn.click()
 
-        _make_post(self.element, self.element, contents)
+        _make_post(element, element, contents)
+        self.snapshot.stale = True
+
+    def __repr__(self):
+        return f"Post({self.postid!r})"
 
 
 class Client:
-    def __init__(self, port, headless=True):
+    def __init__(self, port, headless=True, profile=False):
         self.port = port
+        self.reset_times = []
+        self.profile = profile
+        # Of the last login
+        self.mode = "guest"
 
         options = webdriver.ChromeOptions()
         options.add_argument("ignore-certificate-errors")
         if headless:
             options.add_argument("headless")
 
-        caps = DesiredCapabilities.CHROME
+        caps = DesiredCapabilities.CHROME.copy()
         caps["goog:loggingPrefs"] = {"browser": "ALL"}
+        if profile:
+            profiling.enable(options, caps)
 
         self.driver = webdriver.Chrome(desired_capabilities=caps, options=options)
 
-        self.driver.get(f"https://localhost:{port}/dist/")
+        self.driver.get(self.url)
 
     def __enter__(self):
         return self
@@ -83,6 +147,20 @@ class Client:
     def __exit__(self, _exc_type, _exc_value, _traceback):
         self.close()
 
+    @property
+    def origin(self):
+        return f"https://localhost:{self.port}"
+
+    @property
+    def url(self):
+        return f"{self.origin}/dist/"
+
+    def attach(self, port):
+        # Point a (warm) browser at a different test server
+        self.port = port
+        self.reset_times = []
+        self.driver.get(self.url)
+
     def close(self):
         self.driver.close()
         self.driver.quit()
@@ -90,6 +168,13 @@ class Client:
     def get_logs(self):
         return self.driver.get_log("browser")
 
+    def startProfile(self):
+        assert self.profile, "Client wasn't started with profile=True"
+        profiling.start(self.driver)
+
+    def stopProfile(self):
+        return profiling.stop(self.driver)
+
     @property
     def logged_out(self):
         return any(
@@ -115,55 +200,76 @@ class Client:
         self.driver.find_elements_by_id(mode)[0].click()
 
         self.driver.find_elements_by_id("start")[0].click()
-        sleep(1)
-
-        assert not self.logged_out, self.driver.current_url
+        # Guests are quick, creating an identity generates keys
+        self.mode = mode
+        wait_until(lambda: not self.logged_out, name=f"{mode} login")
 
     def logout(self):
         assert not self.logged_out
         links = self.driver.find_elements_by_tag_name("a")
         link = [l for l in links if l.text == "Logout"][0]
         link.click()
-        while not self.logged_out:
-            sleep(0.5)
+        wait_until(lambda: self.logged_out, name="logout")
 
-    def reset(self):
-        # TODO create a testing mode
-        if self.testing:
-            self.driver.get(f"https://localhost:{self.port}/dist/")
-
-        name_to_clear = None
-        if not self.logged_out:
-            name_to_clear = self.name
-            self.logout()
-
-        self.driver.execute_script("sessionStorage.clear()")
-        self.driver.execute_script("localStorage.clear()")
-        if name_to_clear:
-            # TODO update this
-            self.driver.execute_script(
-                f"""
-                (async () => {{
-                    if (!window.jsstore) {{
-                        await new Promise(r => {{
-                            const s = document.createElement("script");
-                            s.onload = r;
-                            s.src = "./test/helpers/jsstore.min.js";
-                            document.body.appendChild(s);
-                        }});
-                    }}
-                    const w = new Worker(
-                        "./test/helpers/ext_scripts/jsstore.worker.min.js"
-                    );
-                    const conn = new JsStore.Connection(w);
-                    const dbs = await conn.getDbList();
-                    for (let db of dbs) {{
-                        await conn.openDb(db);
-                        await conn.dropDb();
-                    }}
-                }})();
+    def _drop_databases(self):
+        # Fallback for drivers without CDP support. Resolves once every
+        # IndexedDB has been dropped.
+        self.driver.execute_async_script(
             """
+            const done = arguments[arguments.length - 1];
+            (async () => {
+                if (!window.JsStore) {
+                    await new Promise(r => {
+                        const s = document.createElement("script");
+                        s.onload = r;
+                        s.src = "../test/helpers/jsstore.min.js";
+                        document.body.appendChild(s);
+                    });
+                }
+                const w = new Worker(
+                    "../test/helpers/ext_scripts/jsstore.worker.min.js"
+                );
+                const conn = new JsStore.Connection(w);
+                const dbs = await conn.getDbList();
+                for (let db of dbs) {
+                    await conn.openDb(db);
+                    await conn.dropDb();
+                }
+                w.terminate();
+            })().then(done, done);
+        """
+        )
+
+    def reset(self):
+        start = time.time()
+        if self.driver.current_url.startswith(self.origin):
+            self.driver.execute_script("sessionStorage.clear()")
+
+        # Unload the app so that nothing holds the databases open or writes to
+        # them while they are cleared.
+        self.driver.get("about:blank")
+        try:
+            self.driver.execute_cdp_cmd(
+                "Storage.clearDataForOrigin",
+                {"origin": self.origin, "storageTypes": "all"},
             )
+            self.driver.get(self.url)
+        except WebDriverException:
+            self.driver.get(self.url)
+            self.driver.execute_script("localStorage.clear()")
+            self._drop_databases()
+            self.driver.get(self.url)
+
+        WebDriverWait(self.driver, 10, poll_frequency=0.05).until(
+            lambda d: d.execute_script(
+                "return document.readyState === 'complete' && "
+                "!!document.getElementById('page')"
+            )
+        )
+        # Drop logs from before the reset so they aren't mistaken for output
+        # of the next test
+        self.get_logs()
+        self.reset_times.append(time.time() - start)
 
     def post_login_get_element_text(self, elementID):
         assert not self.logged_out, self.driver.current_url
@@ -190,51 +296,151 @@ class Client:
         return self.post_login_get_element_text("totalconnections")
 
     def waitForUserSetup(self):
-        while "?" in self.id:
-            sleep(0.5)
+        assert not self.logged_out, self.driver.current_url
+        wait_for_dom(
+            self.driver,
+            """
+            const el = document.getElementById("id");
+            return !!el && !el.innerText.includes("?");
+            """,
+            name=f"{self.mode} user setup",
+        )
+
+    def waitForPosts(self, count=1):
+        # Wait for at least `count` top level posts to be rendered
+        return wait_for_dom(
+            self.driver,
+            f"""
+            const posts = document.querySelectorAll("#posts > .post");
+            return posts.length >= {count} && posts.length;
+            """,
+            name="posts",
+        )
 
     @property
     def _page_element(self):
         return self.driver.find_element_by_id("page")
 
-    @property
-    def _posts_element(self):
-        return self.driver.find_element_by_id("posts")
-
     def newPost(self, contents):
         _make_post(self.driver, self._page_element, contents)
 
+    def snapshot(self):
+        return PostSnapshot(self.driver)
+
     def getPosts(self):
-        posts = dict()
-        for post in self.driver.find_elements_by_class_name("post"):
-            postid = post.get_attribute("id")
-            if post.find_element_by_xpath("./..") != self._posts_element:
-                continue
-            posts[postid] = Post(post)
+        snapshot = self.snapshot()
+        return {postid: Post(snapshot, postid) for postid in snapshot.toplevel}
 
-        return posts
+
+class ClientLease:
+    def __init__(self, clients):
+        self.clients = clients
+        self.reset_time = 0
+
+    def reset(self):
+        start = time.time()
+        try:
+            for c in self.clients:
+                c.reset()
+        finally:
+            self.reset_time = time.time() - start
+
+
+# Browsers released by a ClientPool are kept warm here so that the next pool
+# in this process (e.g. the next test module) doesn't pay for chrome startup.
+_idle_clients = []
+_idle_lock = threading.Lock()
+
+
+@atexit.register
+def _quit_idle_clients():
+    with _idle_lock:
+        clients = list(_idle_clients)
+        _idle_clients.clear()
+    for c in clients:
+        try:
+            c.close()
+        except Exception:
+            pass
 
 
 class ClientPool:
-    def __init__(self, port, count):
-        self.clients = [None] * count
+    def __init__(self, port, count, profile=False):
+        # Profiling needs different browser options, so only browsers started
+        # the same way are reused
+        with _idle_lock:
+            warm = [c for c in _idle_clients if c.profile == profile][:count]
+            for c in warm:
+                _idle_clients.remove(c)
+        self.clients = warm + [None] * (count - len(warm))
 
         def createClient(idx):
-            self.clients[idx] = Client(port)
+            if self.clients[idx]:
+                try:
+                    self.clients[idx].attach(port)
+                    return
+                except WebDriverException:
+                    # The browser died while idle, replace it
+                    try:
+                        self.clients[idx].close()
+                    except Exception:
+                        pass
+            self.clients[idx] = Client(port, profile=profile)
 
         with ThreadPoolExecutor() as executor:
             for idx in range(count):
                 executor.submit(createClient, idx)
 
-    def destroy(self):
+        self._free = list(self.clients)
+        self._cond = threading.Condition()
+
+    def resetStats(self):
+        stats = []
         for c in self.clients:
-            c.close()
+            times = c.reset_times
+            if times:
+                mean = sum(times) / len(times)
+                stats.append((len(times), mean, max(times)))
+            else:
+                stats.append((0, 0, 0))
+        return stats
+
+    def destroy(self):
+        for idx, (count, mean, worst) in enumerate(self.resetStats()):
+            print(
+                f"client {idx}: {count} reset(s), "
+                f"mean {mean * 1000:.0f}ms, max {worst * 1000:.0f}ms"
+            )
+        with _idle_lock:
+            _idle_clients.extend(c for c in self.clients if c)
         self.clients = []
 
     def reset(self):
         for c in self.clients:
             c.reset()
 
+    @contextmanager
+    def lease(self, count):
+        # Exclusively hand out `count` freshly reset clients, blocking until
+        # enough of them are free.
+        assert count <= len(self.clients), f"Pool only has {len(self.clients)}"
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._free) >= count)
+            clients = self._free[:count]
+            del self._free[:count]
+
+        try:
+            lease = ClientLease(clients)
+            try:
+                lease.reset()
+            except:
+                print("Reset failed!")
+            yield lease
+        finally:
+            with self._cond:
+                self._free += clients
+                self._cond.notify_all()
+
     def __enter__(self):
         return self
 
@@ -0,0 +1,137 @@
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import zlib
+
+import driver
+
+# Which tests exist is cached here so that selecting and sharding tests doesn't
+# need to import every module. Entries are keyed by the module's mtime;
+# modules that build their tests at import time (`testList`) also depend on
+# the layout of the test/ tree.
+index_file = ".test_index.json"
+index_version = 1
+
+
+def find_modules(pattern="*_test.py"):
+    return sorted(glob.glob(os.path.join("test", "**", pattern), recursive=True))
+
+
+def load_module(fullpath):
+    module = os.path.basename(fullpath).rsplit(".", 1)[0]
+    spec = importlib.util.spec_from_file_location(module, fullpath)
+    lib = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lib)
+    return lib
+
+
+def tree_signature(root="test"):
+    # Changes whenever a file below `root` is added, removed or modified
+    digest = hashlib.sha1()
+    for (parent, dirs, files) in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for name in sorted(files):
+            path = os.path.join(parent, name)
+            digest.update(f"{path}:{os.stat(path).st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def collect_module(path):
+    module = load_module(path)
+    tests, config = driver.collectTests(module)
+    return {
+        "module": module.__name__,
+        "dynamic": hasattr(module, "testList"),
+        "tests": [
+            {
+                "name": test.__name__,
+                "clients": driver.clientRequests.get(test.__name__, 0),
+            }
+            for test in tests
+        ],
+        "config": config,
+    }
+
+
+def _load_index():
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if index.get("version") != index_version:
+        return {}
+    return index.get("modules", {})
+
+
+def _save_index(modules):
+    tmp = index_file + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": index_version, "modules": modules}, f, indent=4)
+    os.replace(tmp, index_file)
+
+
+def collect(paths):
+    # Returns {path: entry} for `paths`, importing only modules whose entry is
+    # missing or stale
+    cached = _load_index()
+    signature = None
+    modules = dict()
+    stale = 0
+    for path in paths:
+        mtime = os.stat(path).st_mtime_ns
+        entry = cached.get(path)
+        if entry and entry["mtime"] == mtime and entry["dynamic"]:
+            if signature is None:
+                signature = tree_signature()
+            if entry["tree"] != signature:
+                entry = None
+        elif entry and entry["mtime"] != mtime:
+            entry = None
+
+        if not entry:
+            stale += 1
+            entry = collect_module(path)
+            entry["mtime"] = mtime
+            if entry["dynamic"]:
+                if signature is None:
+                    signature = tree_signature()
+                entry["tree"] = signature
+        modules[path] = entry
+
+    if stale:
+        cached.update(modules)
+        _save_index(cached)
+    print(f"Collected {len(paths)} module(s), {stale} re-imported")
+    return modules
+
+
+def parse_shard(value):
+    # "i/n" with 1 <= i <= n
+    index, count = (int(x) for x in value.split("/"))
+    if not 1 <= index <= count:
+        raise ValueError(f"invalid shard {value}")
+    return index, count
+
+
+def select(modules, keyword=None, shard=None):
+    # Returns {path: [test names]} of the tests matching `keyword` (a substring
+    # of "module:test") that belong to `shard`. Tests are assigned to shards by
+    # a stable hash so shards stay balanced as tests come and go.
+    selected = dict()
+    for path, entry in modules.items():
+        names = []
+        for test in entry["tests"]:
+            testid = f"{entry['module']}:{test['name']}"
+            if keyword and keyword not in testid:
+                continue
+            if shard:
+                index, count = shard
+                if zlib.crc32(testid.encode()) % count != index - 1:
+                    continue
+            names.append(test["name"])
+        if names:
+            selected[path] = names
+    return selected
@@ -1,19 +1,67 @@
+import fcntl
+import hashlib
 import inspect
 import json
 import os
 import shutil
 import signal
+import ssl
 import subprocess
 import sys
+import threading
 import time
 import traceback
+import urllib.request
 
 from concurrent.futures import ThreadPoolExecutor
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from io import StringIO
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp
+
+import profiling
 
 from client import ClientPool
+from peerserver import PeerServer
+from waits import take_counters, wait_for_port
+
+
+class Metrics:
+    # Phase timings and per-test records of a module run. test.py writes them
+    # out as JSON Lines or JUnit XML.
+    def __init__(self, module):
+        self.module = module
+        self.phases = dict()
+        self.info = dict()
+        self.tests = []
+        self.lock = threading.Lock()
+
+    def add(self, phase, elapsed):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0) + elapsed
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def addTest(self, record):
+        with self.lock:
+            self.tests.append(record)
+
+    def toJson(self):
+        return {
+            "module": self.module,
+            "phases": self.phases,
+            "info": self.info,
+            "tests": self.tests,
+        }
+
+
+# Metrics of the module that is currently running
+g_metrics = Metrics(None)
 
 
 def setupEnvironment():
@@ -26,33 +74,206 @@ class BuildOutput:
         self.tempdir = tempdir
 
 
+# ioctl that makes a file share another file's extents (a reflink), see
+# ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def cloneFile(src, dst):
+    # Makes dst (which must not exist) a hardlink, reflink or, failing both, a
+    # copy of src. Hardlinked files must never be written to, only replaced.
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copymode(src, dst)
+
+
+def installFile(src, dst):
+    # Replaces dst instead of writing through it, so files it's linked to are
+    # left alone
+    tmp = f"{dst}.{threading.get_ident()}.tmp"
+    cloneFile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def writeFile(path, data):
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def linkTree(src, dst):
+    shutil.copytree(src, dst, copy_function=cloneFile)
+
+
+# Per module working directories. They live in the repo so that files can be
+# hardlinked from dist/ and the build cache.
+workspace_dir = ".test_workspaces"
+
+
 @contextmanager
-def buildTest(tempdir, do_build, settings_json):
+def workspace(name):
+    os.makedirs(workspace_dir, exist_ok=True)
+    path = os.path.abspath(mkdtemp(dir=workspace_dir, prefix=f"{name}-"))
+    try:
+        yield path
+    finally:
+        # Don't make the next module wait for the removal. The thread isn't a
+        # daemon so the process still finishes it before exiting.
+        threading.Thread(
+            target=shutil.rmtree, args=(path,), kwargs={"ignore_errors": True}
+        ).start()
+
+
+# Webpack output is cached per (build inputs, settings) so that modules that
+# only differ in their test code share a single build.
+build_cache_dir = ".build_cache"
+build_inputs = ["src", "webpack.config.js", "tsconfig.json", "package-lock.json"]
+max_cached_builds = 8
+
+
+def buildKey(settings_json):
+    digest = hashlib.sha1()
+    for input_ in build_inputs:
+        paths = [input_]
+        if os.path.isdir(input_):
+            paths = sorted(
+                os.path.join(parent, f)
+                for (parent, _, files) in os.walk(input_)
+                for f in files
+            )
+        for path in paths:
+            digest.update(path.encode() + b"\0")
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    digest.update(json.dumps(settings_json, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+@contextmanager
+def buildCacheLock(mode):
+    # Held shared from looking a build up until it's installed, and exclusively
+    # to prune, so a build is never removed while another worker uses it
+    os.makedirs(build_cache_dir, exist_ok=True)
+    with open(os.path.join(build_cache_dir, "cache.lock"), "w") as lock:
+        fcntl.flock(lock, mode)
+        yield
+
+
+def pruneBuildCache():
+    builds = [
+        os.path.join(build_cache_dir, d)
+        for d in os.listdir(build_cache_dir)
+        if not d.endswith((".lock", ".tmp"))
+    ]
+    builds.sort(key=os.path.getmtime, reverse=True)
+    for stale in builds[max_cached_builds:]:
+        shutil.rmtree(stale, ignore_errors=True)
+
+
+def cachedBuild(settings_json, log):
+    key = buildKey(settings_json)
+    builddir = os.path.join(build_cache_dir, key)
+    os.makedirs(build_cache_dir, exist_ok=True)
+    # Modules with the same key may be running in other worker processes, only
+    # one of them should build.
+    with open(builddir + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(builddir):
+            print(f"Reusing cached build {key}")
+            g_metrics.info["build_cache"] = "hit"
+            os.utime(builddir)
+            return builddir
+        g_metrics.info["build_cache"] = "miss"
+
+        print(f"Building {key}")
+        with TemporaryDirectory(dir=".", prefix="src") as tempctx:
+            tempsrc = os.path.join(tempctx, "src")
+            linkTree("src", tempsrc)
+            if settings_json:
+                settings_file = os.path.join(tempsrc, "settings/settings_dev.json")
+                writeFile(settings_file, json.dumps(settings_json))
+            tempout = builddir + ".tmp"
+            shutil.rmtree(tempout, ignore_errors=True)
+            cmd = ["webpack"]
+            cmd += ["--context", tempctx]
+            cmd += ["--output-path", tempout]
+            with g_metrics.phase("webpack"):
+                subprocess.check_call(cmd, stdout=log, stderr=log)
+            os.rename(tempout, builddir)
+    return builddir
+
+
+# Settings that differ between runs of the same module, like the peerserver's
+# port, aren't built in: that would give every module its own build. They are
+# set in a script that the workspace's pages load before the app, see
+# src/settings/settings.ts.
+settings_override_script = "settings_override.js"
+settings_override_pages = ["index.html", "test/test.html"]
+
+
+def installSettingsOverride(tempdist, overrides):
+    script = os.path.join(tempdist, settings_override_script)
+    writeFile(script, f"window.settingsOverride = {json.dumps(overrides)};\n")
+    for page in settings_override_pages:
+        path = os.path.join(tempdist, page)
+        try:
+            with open(path) as f:
+                html = f.read()
+        except FileNotFoundError:
+            continue
+        src = os.path.relpath(script, os.path.dirname(path))
+        html = html.replace("<head>", f'<head>\n    <script src="{src}"></script>', 1)
+        writeFile(path, html)
+
+
+@contextmanager
+def buildTest(tempdir, do_build, settings_json, overrides=None):
     try:
         with open("./subprocess_output.log", "a") as log:
-            with TemporaryDirectory(dir=".", prefix="src") as tempctx:
-                tempsrc = os.path.join(tempctx, "src")
-                shutil.copytree("src", tempsrc)
-                tempdist = os.path.join(tempdir, "dist")
-                shutil.copytree("dist", tempdist)
-                shutil.copy("test/lib/localhost.pem", tempdir)
-                temptest = os.path.join(tempdir, "test")
-                shutil.copytree("test", temptest)
-                if settings_json:
-                    with open(
-                        os.path.join(tempsrc, "settings/settings_dev.json"), "w"
-                    ) as f:
-                        f.write(json.dumps(settings_json))
-                if do_build:
-                    cmd = ["webpack"]
-                    cmd += ["--context", tempctx]
-                    cmd += ["--output-path", tempdist]
-                    subprocess.check_call(cmd, stdout=log, stderr=log)
-                yield BuildOutput(log, tempdir)
+            tempdist = os.path.join(tempdir, "dist")
+            with g_metrics.phase("workspace"):
+                linkTree("dist", tempdist)
+                cloneFile(
+                    "test/lib/localhost.pem", os.path.join(tempdir, "localhost.pem")
+                )
+                # Only ever read from, so there's no need for a copy
+                os.symlink(os.path.abspath("test"), os.path.join(tempdir, "test"))
+            if do_build:
+                with buildCacheLock(fcntl.LOCK_SH):
+                    builddir = cachedBuild(settings_json, log)
+                    with g_metrics.phase("install_build"):
+                        shutil.copytree(
+                            builddir,
+                            tempdist,
+                            dirs_exist_ok=True,
+                            copy_function=installFile,
+                        )
+                with buildCacheLock(fcntl.LOCK_EX):
+                    pruneBuildCache()
+            if overrides:
+                installSettingsOverride(tempdist, overrides)
+            yield BuildOutput(log, tempdir)
     finally:
         pass
 
 
+def getServerCacheStats(port):
+    # The test server uses a self-signed certificate
+    context = ssl._create_unverified_context()
+    url = f"https://localhost:{port}/__cache_stats"
+    with urllib.request.urlopen(url, context=context, timeout=5) as resp:
+        return json.load(resp)
+
+
 @contextmanager
 def server(tempdir, port):
     server = None
@@ -62,15 +283,16 @@ def server(tempdir, port):
             cmd += ["--no-build", "--serve"]
             cmd += ["--dir", tempdir]
             cmd += ["--port", str(port)]
-            server = subprocess.Popen(
-                cmd, stdout=log, stderr=log, preexec_fn=os.setpgrp
-            )
-            # TODO spawn a peerserver process and replace the peerserver
-            # host/port in settings.json
-            # TODO poll for the server coming online
-            # TODO check for errors!
-            time.sleep(1)
+            with g_metrics.phase("server_start"):
+                server = subprocess.Popen(
+                    cmd, stdout=log, stderr=log, preexec_fn=os.setpgrp
+                )
+                wait_for_port("localhost", port, proc=server, name="test server")
             yield
+            try:
+                print("server file cache:", getServerCacheStats(port))
+            except Exception as e:
+                print("Could not fetch server cache stats:", e)
     finally:
         try:
             os.kill(-server.pid, signal.SIGINT)
@@ -79,6 +301,31 @@ def server(tempdir, port):
         server.wait()
 
 
+@contextmanager
+def peerserver(port=0):
+    # Signalling for the module's clients, so tests don't depend on the
+    # public peercloud. Any free port will do, clients are pointed at it with
+    # a settings override.
+    with g_metrics.phase("peerserver_start"):
+        ps = PeerServer(port, "test/lib/localhost.pem").start()
+    try:
+        yield ps
+    finally:
+        ps.stop()
+
+
+def peercloudOf(ps):
+    return {"host": "localhost", "port": ps.port, "protocol": "https"}
+
+
+@contextmanager
+def clientPool(port, count):
+    with g_metrics.phase("client_pool_start"):
+        pool = ClientPool(port, count, profile=bool(g_profile))
+    with pool:
+        yield pool
+
+
 @contextmanager
 def Scopes(scopes):
     values = []
@@ -132,12 +379,118 @@ def load_settings_json(test_config):
     return settings_json
 
 
+# Serializes the per-test report lines of concurrently running tests
+output_lock = threading.Lock()
+
+
+class CapturedStdout:
+    # Stand-in for sys.stdout that sends writes from a thread inside capture()
+    # to that thread's buffer, so tests running concurrently each get their
+    # own stdout.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    @contextmanager
+    def capture(self):
+        self.local.buffer = StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            del self.local.buffer
+
+    def write(self, data):
+        return getattr(self.local, "buffer", self.stream).write(data)
+
+    def flush(self):
+        getattr(self.local, "buffer", self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# Directory to save a DevTools trace of every client in every test to, see
+# profiling.py
+g_profile = None
+# Number of functions in the printed profile summaries
+g_profile_top = 15
+
+
+def runTest(test, pool, buildOutput, stdout, verbose=False):
+    num_clients = clientRequests.get(test.__name__, 0)
+    lease_start = time.time()
+    with pool.lease(num_clients) if pool else nullcontext() as lease:
+        lease_time = time.time() - lease_start
+        with output_lock:
+            print("------------------------------")
+            print(f"Running test [{test.__name__}]")
+
+        clients = lease.clients if lease and g_profile else []
+        for c in clients:
+            c.startProfile()
+
+        failed = None
+        with stdout.capture() as captured_stdout:
+            take_counters()
+            start = time.time()
+            try:
+                test(TestInput(lease, buildOutput))
+            except Exception as e:
+                traceback.print_exc()
+                failed = e
+            delta = time.time() - start
+            counters = take_counters()
+
+        profiles = []
+        for idx, c in enumerate(clients):
+            path = os.path.join(
+                g_profile, g_metrics.module or "", f"{test.__name__}.client{idx}.json"
+            )
+            trace = c.stopProfile()
+            profiling.save(trace, path)
+            profiles.append((path, profiling.summary(trace, g_profile_top)))
+
+    g_metrics.addTest(
+        {
+            "name": test.__name__,
+            "clients": num_clients,
+            # Waiting for free clients plus resetting them
+            "lease": lease_time,
+            "reset": lease.reset_time if lease else 0,
+            "body": delta,
+            "waits": counters["waits"],
+            "polls": counters["polls"],
+            # Condition evaluations that came back false
+            "retries": counters["polls"] - counters["waits"],
+            "passed": not failed,
+            "error": repr(failed) if failed else None,
+            "stdout": captured_stdout.getvalue() if failed else None,
+        }
+    )
+
+    with output_lock:
+        if failed:
+            print(f"{test.__name__} Failed! ({delta})")
+            print("================================")
+            print(f"{test.__name__} Produced stdout:")
+            print(captured_stdout.getvalue())
+            print("================================")
+        else:
+            print(f"{test.__name__} passed. ({delta})")
+            if verbose:
+                print(captured_stdout.getvalue(), end="")
+        for idx, (path, summary) in enumerate(profiles):
+            print(f"Profile of client {idx}, saved to {path}:")
+            for line in summary:
+                print(f"    {line}")
+    return (test.__name__, delta) if failed else None
+
+
 g_port = 8000
 
 
-def main(module):
-    global g_port
-    setupEnvironment()
+def collectTests(module):
+    # Returns the module's tests and its test_config
     moduleMembers = dict(inspect.getmembers(module))
     tests = []
     if "testList" in moduleMembers:
@@ -147,6 +500,18 @@ def main(module):
         for f in moduleMembers.values()
         if (inspect.isfunction(f) and f.__name__.startswith("test"))
     ]
+    return tests, moduleMembers.get("test_config", {})
+
+
+def runModule(module, selection=None):
+    # `selection` optionally limits the run to the tests with those names
+    global g_port, g_metrics
+    setupEnvironment()
+    g_metrics = Metrics(module.__name__)
+    module_start = time.time()
+    tests, module_config = collectTests(module)
+    if selection is not None:
+        tests = [test for test in tests if test.__name__ in selection]
     print(f"Running {len(tests)} test(s).")
     for test in tests:
         print(f"\t{module.__name__}:{test.__name__}")
@@ -155,25 +520,45 @@ def main(module):
         "rebuild_required": True,
         "server_required": True,
         "settings_json": {},
+        # Number of tests that may run concurrently, each with its own clients
+        "parallel_tests": 1,
+        # Use a local signalling server instead of the one in settings.json.
+        # Only when rebuilding, dist/ may be a release build that ignores
+        # settings overrides.
+        "local_peerserver": True,
+        # Also show the stdout of tests that passed
+        "verbose": False,
     }
-    if "test_config" in moduleMembers:
-        test_config.update(moduleMembers["test_config"])
+    test_config.update(module_config)
 
-    settings_json = load_settings_json(test_config)
+    local_peerserver = None
+    if test_config["rebuild_required"] and test_config["local_peerserver"]:
+        local_peerserver = peerserver()
     port = g_port
     g_port += 1
 
     print(f"{module.__name__} using port {port}")
 
-    max_clients = max(list(clientRequests.values()) + [0])
+    # Enough clients to run the `parallel_tests` most demanding tests at once
+    parallel_tests = max(test_config["parallel_tests"], 1)
+    client_counts = sorted(
+        [clientRequests.get(test.__name__, 0) for test in tests], reverse=True
+    )
+    max_clients = sum(client_counts[:parallel_tests])
     failures = []
 
-    with TemporaryDirectory() as tempdir:
+    with workspace(module.__name__) as tempdir, local_peerserver or nullcontext() as ps:
+        overrides = None
+        if ps:
+            print(f"peerserver running on port {ps.port}")
+            overrides = {"peercloud": peercloudOf(ps)}
+        settings_json = load_settings_json(test_config)
+
         scopes = []
         scopes.append(
             (
                 buildTest,
-                (tempdir, test_config["rebuild_required"], settings_json),
+                (tempdir, test_config["rebuild_required"], settings_json, overrides),
                 lambda: print("Finished rebuilding!"),
             )
         )
@@ -187,55 +572,43 @@ def main(module):
 
         if max_clients:
             scopes.append(
-                (ClientPool, (port, max_clients), lambda: print("clients initialized!"))
+                (clientPool, (port, max_clients), lambda: print("clients initialized!"))
             )
         else:
             scopes.append(SKIPSCOPE)
 
-        with Scopes(scopes) as (buildOutput, _, pool):
-            for test in tests:
-                # TODO use a threadpool to run all tests in parallel if
-                # possible.  Will need to pass in arrays of clients instead of
-                # the clientPool directly in that case.
-                print("------------------------------")
-                print(f"Running test [{test.__name__}]")
-
-                num_clients = clientRequests.get(test.__name__, 0)
-                # TODO only reset num_clients clients and isolate them somehow?
-                try:
-                    pool.reset()
-                except:
-                    print("Reset failed!")
-
-                old_stdout = sys.stdout
-                sys.stdout = captured_stdout = StringIO()
-                failed = None
-
-                start = time.time()
-                try:
-                    test(TestInput(pool, buildOutput))
-                except Exception as e:
-                    traceback.print_exc()
-                    failed = e
-                delta = time.time() - start
-
-                sys.stdout = old_stdout
-                if failed:
-                    print(f"{test.__name__} Failed! ({delta})")
-                    print("================================")
-                    print(f"{test.__name__} Produced stdout:")
-                    print(captured_stdout.getvalue())
-                    print("================================")
-                    failures.append((test.__name__, delta))
-                else:
-                    print(f"{test.__name__} passed. ({delta})")
-
+        stdout = CapturedStdout(sys.stdout)
+        sys.stdout = stdout
+        try:
+            with Scopes(scopes) as (buildOutput, _, pool):
+                g_metrics.add("setup", time.time() - module_start)
+                with g_metrics.phase("tests"), ThreadPoolExecutor(
+                    max_workers=parallel_tests
+                ) as executor:
+                    results = executor.map(
+                        lambda test: runTest(
+                            test, pool, buildOutput, stdout, test_config["verbose"]
+                        ),
+                        tests,
+                    )
+                    failures = [failure for failure in results if failure]
+        finally:
+            sys.stdout = stdout.stream
+
+    g_metrics.add("total", time.time() - module_start)
+    g_metrics.info["clients"] = max_clients
+    g_metrics.info["parallel_tests"] = parallel_tests
+
+    print("-----")
     if len(failures):
-        print("-----")
         print("Failures:")
         for failure in failures:
             print("    ", failure[0], failure[1])
-        sys.exit(1)
     else:
-        print("-----")
         print("All tests passed!")
+    return failures
+
+
+def main(module):
+    if runModule(module):
+        sys.exit(1)
@@ -0,0 +1,37 @@
+import os
+
+from tempfile import TemporaryDirectory
+
+import driver
+
+test_config = {"rebuild_required": False, "server_required": False}
+
+
+class FakePeerServer:
+    def __init__(self, port):
+        self.port = port
+
+
+def test_build_shared_across_peerservers(_testInput):
+    # Two modules with the same config, each with its own peerserver, get one
+    # build. The peerserver only shows up in their workspaces.
+    config = {"settings_json": {"intervals": {"queryposts": 100}}}
+    keys = set()
+    with TemporaryDirectory() as tempdir:
+        for port in [20001, 20002]:
+            keys.add(driver.buildKey(driver.load_settings_json(config)))
+
+            tempdist = os.path.join(tempdir, str(port))
+            os.makedirs(os.path.join(tempdist, "test"))
+            for page in driver.settings_override_pages:
+                with open(os.path.join(tempdist, page), "w") as f:
+                    f.write('<head>\n    <script src="./index.js"></script>\n')
+            overrides = {"peercloud": driver.peercloudOf(FakePeerServer(port))}
+            driver.installSettingsOverride(tempdist, overrides)
+
+            with open(os.path.join(tempdist, "settings_override.js")) as f:
+                assert f'"port": {port}' in f.read()
+            with open(os.path.join(tempdist, "test/test.html")) as f:
+                html = f.read()
+            assert html.index("../settings_override.js") < html.index("index.js"), html
+    assert len(keys) == 1, keys
@@ -0,0 +1,683 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+from bisect import bisect_right
+
+from bench import percentile
+
+# Discrete-event model of the post and identity sync protocol in src/client.ts,
+# for networks far bigger than the browser based loadtest.py can start. Each
+# peer follows the same rules as the client: QUERYPOSTS to every open
+# connection each `queryposts` interval, answered with the descriptors added
+# since the last answer to that peer, one REQUESTPOSTS per unknown post, posts
+# from unknown authors held back until a QUERYIDENTRESP arrives, and one new
+# connection per `refreshconnections` interval up to `maxconnections`.
+# With `postquery.filter` set, queries carry a Bloom filter of the querier's
+# posts instead (see src/bloom.ts) and only the missing descriptors come back.
+#
+# Things the model leaves out: CPU time, IndexedDB, message loss, cache pruning
+# and peers leaving. Peer discovery picks uniformly from every peer instead of
+# keeping a potentialPeers list.
+
+settings_file = "src/settings/settings_dev.json"
+messages_file = "src/messages.ts"
+
+# Rough JSON sizes in bytes of the parts of each message, see messages.ts and
+# post.ts. Ids are base32 SHA-256 hashes of the public key and post ids are
+# `${name}@${authorId}:[${timestamp}]${hash}`.
+sizes = {
+    "framing": 48,  # SCTP/DTLS per message
+    "envelope": 24,  # {"type": ...}
+    "ident": 100,  # {"name": ..., "id": ...}
+    "jwk": 260,  # 1024 bit RSA public key
+    "postid": 160,
+    "descriptor": 190,  # {"id": ..., "timestamp": ...}
+    "signature": 180,  # 128 bytes as a JSON object
+    "post": 120,  # the remaining keys of a post
+    "range": 24,  # "since": ...
+    "filter": 48,  # {"bits", "size", "hashes", "seed"} without the bits
+}
+
+
+def load_message_types(path=messages_file):
+    # {NAME: value} for the MessageTypes enum, so the report uses the same
+    # names as the client
+    with open(path) as f:
+        source = f.read()
+    body = re.search(r"enum MessageTypes \{(.*?)\}", source, re.S).group(1)
+    types = dict(re.findall(r"(\w+) = \"(\w*)\"", body))
+    types.pop("_INVALID", None)
+    return types
+
+
+def load_settings(path=settings_file, overrides=None):
+    with open(path) as f:
+        settings = json.load(f)
+    for k, v in (overrides or {}).items():
+        if type(v) == dict:
+            settings[k].update(v)
+        else:
+            settings[k] = v
+    return settings
+
+
+class Simulation:
+    def __init__(self, args, settings, types):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.types = types
+        self.max_connections = settings["maxconnections"]
+        self.connection_timeout = settings["connectiontimeout"] / 1000
+        intervals = settings["intervals"]
+        self.query_posts_interval = intervals["queryposts"] / 1000
+        self.query_idents_interval = intervals["queryidents"] / 1000
+        self.refresh_interval = intervals["refreshconnections"] / 1000
+        postquery = settings["postquery"]
+        self.filter = postquery["filter"]
+        self.window = postquery["window"] / 1000
+        self.full_sync = postquery["fullsync"]
+        self.false_positive = postquery["falsepositive"]
+
+        n = args.peers
+        self.now = 0.0
+        self.events = []
+        self.seq = itertools.count()
+        # One way latency of a link is the sum of both ends' access latency
+        self.access = [self.rng.uniform(*args.latency) / 2 for _ in range(n)]
+        self.uplink_free = [0.0] * n
+        # peer -> {peer: [open, time, synced]}, like connectionsMap
+        self.conns = [dict() for _ in range(n)]
+        self.query_timers = [dict() for _ in range(n)]
+        self.query_ticks = [0] * n
+        # The post cache as a list of (added time, post) plus a set for lookups
+        self.added_times = [[] for _ in range(n)]
+        self.added_posts = [[] for _ in range(n)]
+        self.posts = [set() for _ in range(n)]
+        # author -> set of posts waiting for that author's identity
+        self.unverified = [dict() for _ in range(n)]
+        self.known_ids = [{i} for i in range(n)]
+        self.unknown_ids = [set() for _ in range(n)]
+        self.ident_timer = [False] * n
+        self.start_time = [0.0] * n
+
+        self.post_author = []
+        self.post_created = []
+        self.post_size = []
+        self.post_seen = []
+        self.post_converged = []
+        self.delays = []
+        self.remaining = 0
+
+        self.bytes_sent = [0] * n
+        self.bytes_received = [0] * n
+        self.sent = {name: 0 for name in types}
+        self.sent_bytes = {name: 0 for name in types}
+        self.dropped = 0
+        self.connects = 0
+        self.rejects = 0
+        self.drops = 0
+        self.events_run = 0
+
+        self.bandwidth = args.bandwidth
+        self.first_post = args.join + args.warmup
+        envelope = sizes["framing"] + sizes["envelope"]
+        self.fixed_size = {
+            "QUERYPOSTS": envelope,
+            "QUERYPOSTSRESP": envelope,
+            "REQUESTPOSTS": envelope + sizes["postid"],
+            "QUERYIDENT": envelope + sizes["ident"],
+            "QUERYIDENTRESP": envelope + sizes["ident"] + sizes["jwk"],
+        }
+
+        self.handlers = {
+            "POST": self.recv_post,
+            "QUERYPOSTS": self.recv_post_query,
+            "QUERYPOSTSRESP": self.recv_post_query_resp,
+            "REQUESTPOSTS": self.recv_request_post,
+            "QUERYIDENT": self.recv_query_ident,
+            "QUERYIDENTRESP": self.recv_query_ident_resp,
+        }
+
+    def schedule(self, when, fn, *args):
+        heapq.heappush(self.events, (when, next(self.seq), fn, args))
+
+    def every(self, interval, fn, peer):
+        fn(peer)
+        self.schedule(self.now + interval, self.every, interval, fn, peer)
+
+    def latency(self, a, b):
+        return self.access[a] + self.access[b]
+
+    # Messages
+
+    def message_size(self, mtype, data):
+        if mtype == "POST":
+            return self.post_size[data]
+        if mtype == "QUERYPOSTS" and data:
+            return self.fixed_size[mtype] + data[1]
+        if mtype == "QUERYPOSTSRESP":
+            # Posts created during the run plus descriptors of --cached posts
+            count = len(data[0]) + data[1]
+            return self.fixed_size[mtype] + count * (sizes["descriptor"] + 1)
+        return self.fixed_size[mtype]
+
+    def filter_size(self, count):
+        # Bytes of a query with a Bloom filter for `count` posts, sized like
+        # BloomFilter.forCapacity
+        bits = -max(1, count) * math.log(self.false_positive) / math.log(2) ** 2
+        return math.ceil(bits / 8) + sizes["filter"] + sizes["range"]
+
+    def send(self, src, dst, mtype, data=None):
+        size = self.message_size(mtype, data)
+        # Messages leave one at a time through the sender's uplink
+        start = self.uplink_free[src]
+        if start < self.now:
+            start = self.now
+        done = start + size / self.bandwidth
+        self.uplink_free[src] = done
+        self.bytes_sent[src] += size
+        self.sent[mtype] += 1
+        self.sent_bytes[mtype] += size
+        arrival = done + self.access[src] + self.access[dst]
+
+        if mtype == "QUERYPOSTSRESP" and not data[0]:
+            # Nothing happens when a response without new posts arrives, so
+            # skip the event
+            self.bytes_received[dst] += size
+        elif mtype == "QUERYPOSTS" and arrival < self.first_post:
+            # Before the first post responses only have cached posts, answer
+            # right away instead of going through the event queue. This is
+            # most of the events during the warmup.
+            self.bytes_received[dst] += size
+            cached = 0
+            if data is None:
+                if src not in self.query_timers[dst]:
+                    cached = self.args.cached
+                self.query_timers[dst][src] = arrival
+            size = self.message_size("QUERYPOSTSRESP", ((), cached))
+            self.sent["QUERYPOSTSRESP"] += 1
+            self.sent_bytes["QUERYPOSTSRESP"] += size
+            self.bytes_sent[dst] += size
+            self.bytes_received[src] += size
+        else:
+            heapq.heappush(
+                self.events,
+                (arrival, next(self.seq), self.deliver, (src, dst, mtype, data, size)),
+            )
+
+    def deliver(self, src, dst, mtype, data, size):
+        entry = self.conns[dst].get(src)
+        if not entry or not entry[0]:
+            # The channel closed while the message was in flight
+            self.dropped += 1
+            return
+        self.bytes_received[dst] += size
+        self.handlers[mtype](dst, src, data)
+
+    def broadcast(self, peer, mtype, data=None, exclude=None):
+        conns = self.conns[peer]
+        for other, entry in list(conns.items()):
+            if other == exclude:
+                continue
+            if entry[0]:
+                self.send(peer, other, mtype, data)
+            elif self.now - entry[1] > self.connection_timeout:
+                del conns[other]
+
+    # Posts
+
+    def add_post(self, peer, post):
+        if post in self.posts[peer]:
+            return
+        self.posts[peer].add(post)
+        self.added_times[peer].append(self.now)
+        self.added_posts[peer].append(post)
+        self.unverified[peer].get(self.post_author[post], set()).discard(post)
+
+        self.post_seen[post] += 1
+        if self.post_seen[post] > 1:
+            # The first peer to have a post is its author
+            self.delays.append(self.now - self.post_created[post])
+        if self.post_seen[post] == self.args.peers:
+            self.post_converged[post] = self.now - self.post_created[post]
+            self.remaining -= 1
+
+    def recv_post(self, peer, _src, post):
+        if post in self.posts[peer]:
+            return
+        author = self.post_author[post]
+        if author is None or author in self.known_ids[peer]:
+            self.add_post(peer, post)
+            return
+        self.unverified[peer].setdefault(author, set()).add(post)
+        self.add_unknown_id(peer, author)
+        self.broadcast(peer, "QUERYIDENT", author)
+
+    def query_posts(self, peer):
+        if not self.filter:
+            self.broadcast(peer, "QUERYPOSTS")
+            return
+
+        # Same choice between full and recent queries as Client.queryPosts
+        full_sync = self.query_ticks[peer] % self.full_sync == 0
+        self.query_ticks[peer] += 1
+        since = self.now - self.window
+        full = recent = None
+        conns = self.conns[peer]
+        for other, entry in list(conns.items()):
+            if not entry[0]:
+                if self.now - entry[1] > self.connection_timeout:
+                    del conns[other]
+                continue
+            if full_sync or not entry[2]:
+                if full is None:
+                    count = self.count_posts(peer) + self.args.cached
+                    full = (None, self.filter_size(count))
+                query = full
+            else:
+                if recent is None:
+                    recent = (since, self.filter_size(self.count_posts(peer, since)))
+                query = recent
+            entry[2] = True
+            self.send(peer, other, "QUERYPOSTS", query)
+
+    def count_posts(self, peer, since=None):
+        # Posts in both caches created at or after `since`
+        posts = itertools.chain(self.posts[peer], *self.unverified[peer].values())
+        if since is None:
+            return sum(1 for _ in posts)
+        return sum(1 for post in posts if self.post_created[post] >= since)
+
+    def recv_post_query(self, peer, src, query):
+        if query is not None:
+            # Everything in the range the querier doesn't have, except for
+            # false positives of the filter. Membership is checked against
+            # the querier's current posts rather than a copy from when the
+            # query was sent.
+            since = query[0]
+            theirs = self.posts[src]
+            unverified = self.unverified[src]
+            missing = []
+            for post in self.added_posts[peer]:
+                if since is not None and self.post_created[post] < since:
+                    continue
+                if post in theirs:
+                    continue
+                if post in unverified.get(self.post_author[post], ()):
+                    continue
+                if self.rng.random() < self.false_positive:
+                    continue
+                missing.append(post)
+            self.send(peer, src, "QUERYPOSTSRESP", (missing, 0))
+            return
+
+        last = self.query_timers[peer].get(src)
+        posts = self.added_posts[peer]
+        cached = self.args.cached
+        if last is not None:
+            posts = posts[bisect_right(self.added_times[peer], last) :]
+            cached = 0
+        self.send(peer, src, "QUERYPOSTSRESP", (posts, cached))
+        self.query_timers[peer][src] = self.now
+
+    def recv_post_query_resp(self, peer, src, response):
+        posts = response[0]
+        unverified = self.unverified[peer]
+        for post in posts:
+            if post in self.posts[peer]:
+                continue
+            author = self.post_author[post]
+            if author is not None and post in unverified.get(author, ()):
+                continue
+            self.send(peer, src, "REQUESTPOSTS", post)
+
+    def recv_request_post(self, peer, src, post):
+        if post in self.posts[peer]:
+            self.send(peer, src, "POST", post)
+
+    def create_post(self, peer):
+        post = len(self.post_created)
+        signed = self.rng.random() >= self.args.guests
+        self.post_author.append(peer if signed else None)
+        self.post_created.append(self.now)
+        self.post_size.append(
+            sizes["framing"]
+            + sizes["envelope"]
+            + sizes["post"]
+            + sizes["ident"]
+            + sizes["descriptor"]
+            + self.args.post_size
+            + (sizes["signature"] if signed else 0)
+        )
+        self.post_seen.append(0)
+        self.post_converged.append(None)
+        self.remaining += 1
+        self.add_post(peer, post)
+        self.broadcast(peer, "POST", post)
+
+    # Identities
+
+    def add_unknown_id(self, peer, ident):
+        self.unknown_ids[peer].add(ident)
+        if not self.ident_timer[peer]:
+            # queryIdents runs every interval but only sends anything while
+            # there are unknown ids, so it is only scheduled then
+            self.ident_timer[peer] = True
+            interval = self.query_idents_interval
+            ticks = (self.now - self.start_time[peer]) // interval + 1
+            when = self.start_time[peer] + ticks * interval
+            self.schedule(when, self.query_idents, peer)
+
+    def query_idents(self, peer):
+        for ident in list(self.unknown_ids[peer]):
+            self.broadcast(peer, "QUERYIDENT", ident)
+        if self.unknown_ids[peer]:
+            self.schedule(
+                self.now + self.query_idents_interval, self.query_idents, peer
+            )
+        else:
+            self.ident_timer[peer] = False
+
+    def recv_query_ident(self, peer, src, ident):
+        if ident in self.known_ids[peer]:
+            self.send(peer, src, "QUERYIDENTRESP", ident)
+        elif ident not in self.unknown_ids[peer]:
+            self.add_unknown_id(peer, ident)
+            # Ask neighbors except the one that asked
+            self.broadcast(peer, "QUERYIDENT", ident, exclude=src)
+
+    def recv_query_ident_resp(self, peer, _src, ident):
+        self.unknown_ids[peer].discard(ident)
+        if ident in self.known_ids[peer]:
+            return
+        self.known_ids[peer].add(ident)
+        for post in sorted(self.unverified[peer].pop(ident, ())):
+            self.add_post(peer, post)
+
+    # Connections
+
+    def refresh_connections(self, peer):
+        conns = self.conns[peer]
+        if len(conns) == self.max_connections:
+            # Randomly try to drop a connection half the time
+            if self.rng.random() > 0.5:
+                other = self.rng.choice(list(conns))
+                entry = conns[other]
+                if not entry[0] or self.now - entry[1] < self.refresh_interval:
+                    return
+                del conns[other]
+                self.drops += 1
+                self.schedule(
+                    self.now + self.latency(peer, other), self.closed, other, peer
+                )
+            return
+
+        other = self.rng.randrange(self.args.peers - 1)
+        if other >= peer:
+            other += 1
+        if other in conns:
+            return
+        conns[other] = [False, self.now, False]
+        self.connects += 1
+        self.schedule(self.now + self.latency(peer, other), self.accept, other, peer)
+
+    def accept(self, peer, other):
+        # Offer from `other` relayed by the peerserver
+        conns = self.conns[peer]
+        rtt = 2 * self.latency(peer, other)
+        if len(conns) + 1 > self.max_connections or other in conns:
+            self.rejects += 1
+            self.schedule(self.now + rtt / 2, self.closed, other, peer)
+            return
+        conns[other] = [False, self.now, False]
+        # ICE and the DTLS handshake take about another round trip
+        self.schedule(self.now + rtt, self.opened, peer, other)
+        self.schedule(self.now + rtt / 2 + rtt, self.opened, other, peer)
+
+    def opened(self, peer, other):
+        entry = self.conns[peer].get(other)
+        if entry:
+            entry[0] = True
+
+    def closed(self, peer, other):
+        self.conns[peer].pop(other, None)
+
+    # Running
+
+    def start_peer(self, peer):
+        self.start_time[peer] = self.now
+        self.schedule(
+            self.now, self.every, self.refresh_interval, self.refresh_connections, peer
+        )
+        self.schedule(
+            self.now + self.query_posts_interval,
+            self.every,
+            self.query_posts_interval,
+            self.query_posts,
+            peer,
+        )
+
+    def run(self):
+        args = self.args
+        for peer in range(args.peers):
+            self.schedule(self.rng.uniform(0, args.join), self.start_peer, peer)
+        injecting = args.join + args.warmup
+        for i in range(args.posts):
+            when = injecting + args.duration * i / max(1, args.posts)
+            if args.authors:
+                author = self.rng.randrange(min(args.authors, args.peers))
+            else:
+                author = self.rng.randrange(args.peers)
+            self.schedule(when, self.create_post, author)
+        deadline = injecting + args.duration + args.settle
+
+        started = time.time()
+        self.run_until(injecting)
+        idle_bytes = sum(self.bytes_sent)
+        self.run_until(deadline, injecting + args.duration)
+        return self.report(time.time() - started, idle_bytes, injecting)
+
+    def run_until(self, deadline, settled=None):
+        # Runs events up to `deadline`, or until every post has converged
+        # once past `settled`
+        events = self.events
+        pop = heapq.heappop
+        while events and events[0][0] <= deadline:
+            when, _, fn, fnargs = pop(events)
+            self.now = when
+            fn(*fnargs)
+            self.events_run += 1
+            if settled is not None and when >= settled and not self.remaining:
+                break
+
+    def report(self, elapsed, idle_bytes, injecting):
+        args = self.args
+        n = args.peers
+        posts = len(self.post_created)
+        active = max(self.now - injecting, 1e-9)
+        traffic = sorted(s + r for s, r in zip(self.bytes_sent, self.bytes_received))
+        converged = sorted(t for t in self.post_converged if t is not None)
+        delays = sorted(self.delays)
+        delivered = posts * (n - 1)
+        useful = sum(self.post_size) * (n - 1)
+        active_bytes = sum(self.bytes_sent) - idle_bytes
+        degree = sorted(sum(e[0] for e in c.values()) for c in self.conns)
+
+        def stats(values):
+            return {
+                "p50": percentile(values, 50),
+                "p90": percentile(values, 90),
+                "p99": percentile(values, 99),
+                "max": values[-1] if values else None,
+            }
+
+        return {
+            "peers": n,
+            "posts": posts,
+            "cached": args.cached,
+            "protocol": "bloom" if self.filter else "timers",
+            "settings": {
+                "maxconnections": self.max_connections,
+                "intervals": {
+                    "queryposts": self.query_posts_interval * 1000,
+                    "queryidents": self.query_idents_interval * 1000,
+                    "refreshconnections": self.refresh_interval * 1000,
+                },
+            },
+            "simulated_seconds": self.now,
+            "wall_seconds": elapsed,
+            "events": self.events_run,
+            "converged": len(converged),
+            # Seconds from creating a post until every peer has it
+            "convergence": stats(converged),
+            # Seconds from creating a post until each peer has it
+            "delay": stats(delays),
+            "coverage": len(delays) / delivered if delivered else 1,
+            "degree": stats(degree),
+            "connections": {
+                "attempts": self.connects,
+                "rejected": self.rejects,
+                "dropped": self.drops,
+            },
+            # Bytes per second sent and received by each peer while posts were
+            # spreading, and the background rate before the first post
+            "bandwidth": stats([t / self.now for t in traffic]) if self.now else {},
+            "idle_bytes_per_peer_s": idle_bytes / injecting / n if injecting else None,
+            "active_bytes_per_peer_s": active_bytes / active / n,
+            "messages": {
+                self.types[name]: {"count": count, "bytes": self.sent_bytes[name]}
+                for name, count in self.sent.items()
+            },
+            "dropped_in_flight": self.dropped,
+            # POST messages per post delivered, and all bytes sent after the
+            # first post per byte of post delivered
+            "amplification": {
+                "posts": self.sent["POST"] / delivered if delivered else None,
+                "bytes": active_bytes / useful if useful else None,
+            },
+        }
+
+
+def simulate(args, settings=None, types=None):
+    settings = settings or load_settings(args.settings_file, args.settings)
+    types = types or load_message_types()
+    return Simulation(args, settings, types).run()
+
+
+def print_report(report):
+    def fmt(value, unit="s"):
+        return "n/a" if value is None else f"{value:.2f}{unit}"
+
+    print("==============================")
+    print(
+        f"{report['posts']} post(s) to {report['peers']} peer(s), "
+        f"{report['simulated_seconds']:.0f}s simulated in "
+        f"{report['wall_seconds']:.1f}s ({report['events']} events)"
+    )
+    print(f"protocol: {report['protocol']}, {report['cached']} cached post(s)")
+    print(f"converged: {report['converged']}/{report['posts']}")
+    print(f"coverage: {report['coverage'] * 100:.1f}%")
+    for key in ["convergence", "delay"]:
+        print(f"{key}:")
+        for name, value in report[key].items():
+            print(f"    {name}: {fmt(value)}")
+    print(f"open connections per peer: p50 {report['degree']['p50']}")
+    print(
+        f"bytes/s per peer: idle {fmt(report['idle_bytes_per_peer_s'], '')}, "
+        f"active {fmt(report['active_bytes_per_peer_s'], '')}"
+    )
+    amplification = report["amplification"]
+    print(
+        f"amplification: {fmt(amplification['posts'], 'x')} POST messages, "
+        f"{fmt(amplification['bytes'], 'x')} bytes"
+    )
+    print("messages sent (count, bytes):")
+    for msgtype, counts in sorted(report["messages"].items()):
+        print(f"    {msgtype}: {counts['count']} ({counts['bytes']})")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Simulate post and identity sync between many peers"
+    )
+    parser.add_argument("-n", "--peers", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=100, help="posts to create")
+    parser.add_argument(
+        "--authors",
+        type=int,
+        default=10,
+        help="how many peers create the posts, 0 for any peer",
+    )
+    parser.add_argument(
+        "--guests", type=float, default=0, help="fraction of posts by guests"
+    )
+    parser.add_argument("--post-size", type=int, default=280, help="bytes of text")
+    parser.add_argument(
+        "--cached",
+        type=int,
+        default=0,
+        help="posts every peer already has when the simulation starts",
+    )
+    parser.add_argument(
+        "--latency",
+        type=lambda s: tuple(float(x) / 1000 for x in s.split(",")),
+        default=(0.02, 0.2),
+        help="min,max one way link latency in ms",
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=1e6, help="uplink bytes per second"
+    )
+    parser.add_argument(
+        "--join", type=float, default=10, help="seconds over which peers start"
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=60,
+        help="seconds after joining before the first post",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=30, help="seconds over which posts are made"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=120, help="seconds to wait for convergence"
+    )
+    parser.add_argument(
+        "--settings",
+        type=json.loads,
+        default={},
+        help="JSON overrides for settings_dev.json, e.g. '{\"maxconnections\": 5}'",
+    )
+    parser.add_argument("--settings-file", default=settings_file)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+    if args.peers < 2:
+        parser.error("need at least 2 peers")
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    toplevel = subprocess.check_output(["git", "rev-parse", "--show-toplevel"])
+    os.chdir(toplevel.strip())
+
+    report = simulate(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,63 @@
+import json
+
+import gossipsim
+
+test_config = {"rebuild_required": False, "server_required": False}
+
+
+def simulate(*argv):
+    return gossipsim.simulate(gossipsim.parse_args(["--seed", "1", *argv]))
+
+
+def test_message_types_match_client(_testInput):
+    types = gossipsim.load_message_types()
+    assert types["QUERYPOSTS"] == "queryposts", types
+    assert set(types) == {
+        "POST",
+        "QUERYPOSTS",
+        "QUERYPOSTSRESP",
+        "REQUESTPOSTS",
+        "QUERYIDENT",
+        "QUERYIDENTRESP",
+    }, types
+
+
+def test_posts_converge(_testInput):
+    report = simulate("-n", "50", "--posts", "5", "--warmup", "30", "--settle", "60")
+    assert report["converged"] == 5, report
+    assert report["coverage"] == 1, report
+    assert report["degree"]["max"] <= 10, report["degree"]
+    # Every post reached every other peer at least once
+    assert report["amplification"]["posts"] >= 1, report["amplification"]
+    # Posts by users with an identity need the author's key first
+    assert report["messages"]["queryidentresp"]["count"] > 0, report["messages"]
+
+
+def test_guest_posts_skip_identity_queries(_testInput):
+    report = simulate(
+        "-n", "30", "--posts", "3", "--guests", "1", "--warmup", "30", "--settle", "60"
+    )
+    assert report["converged"] == 3, report
+    assert report["messages"]["queryident"]["count"] == 0, report["messages"]
+
+
+def test_filter_queries_skip_cached_posts(_testInput):
+    def response_bytes(use_filter):
+        report = simulate(
+            "-n",
+            "30",
+            "--posts",
+            "3",
+            "--cached",
+            "1000",
+            "--warmup",
+            "30",
+            "--settle",
+            "60",
+            "--settings",
+            json.dumps({"postquery": {"filter": use_filter}}),
+        )
+        assert report["converged"] == 3, report
+        return report["messages"]["querypostsresp"]["bytes"]
+
+    assert response_bytes(True) * 10 < response_bytes(False)
@@ -0,0 +1,44 @@
+# Runs the test/js suites in a client's browser, for no_ui_test.py and
+# no_ui_bench.py
+from driver import requiresClients
+from waits import wait_for_log
+
+
+def generateJsTest(path, verify=None):
+    def test_(testInput):
+        client = testInput.pool.clients[0]
+        doTest(client, path)
+        (verify or verifyTest)(client, path)
+
+    # requiresClients is keyed by name
+    test_.__name__ = path.replace("/", "_").replace(".", "__")
+    return requiresClients(1)(test_)
+
+
+def doTest(client, path):
+    client.reset()
+    client.driver.get(f"https://localhost:{client.port}/dist/test/test.html")
+    client.driver.execute_script(f"import('/{path}');")
+
+
+def printLog(log):
+    if log["source"] != "other":
+        print(log)
+
+
+def verifyTest(client, path, on_log=printLog, timeout=None):
+    def finished(log):
+        if log["source"] == "other":
+            return False
+        return (
+            "[SUITE] SUCCESS" in log["message"]
+            or "[SUITE] FAILED" in log["message"]
+            or log["level"] == "SEVERE"
+        )
+
+    # Suites take very different times
+    log = wait_for_log(
+        client, finished, name=f"js suite {path}", timeout=timeout, on_log=on_log
+    )
+    if "[SUITE] SUCCESS" not in log["message"]:
+        raise Exception(str(log))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from tempfile import TemporaryDirectory
+
+import driver
+
+from bench import percentile
+from client import ClientPool
+from waits import set_script_timeout, wait_until
+
+# Starts many headless peers (mocked clients from window.test, several per
+# browser) against a local peerserver, injects posts at a fixed rate and
+# records when every post becomes visible at every peer.
+
+_harness_script = """
+const [settings, names, done] = arguments;
+window.loadtest = {peers: [], seen: {}, messages: {}};
+const state = window.loadtest;
+for (const name of names) {
+    const mocked = test.newMockedClient(settings, name, "guest");
+    const client = mocked.client;
+    await client.setupWaiter;
+
+    // First time each post is rendered at this peer
+    const renderPost = client.ui.renderPost;
+    client.ui.renderPost = (post, editable, update) => {
+        const seen = (state.seen[post.desc.id] = state.seen[post.desc.id] || {});
+        if (!(name in seen)) seen[name] = Date.now();
+        return renderPost(post, editable, update);
+    };
+
+    const recv = client.recv.bind(client);
+    client.recv = (conn, data) => {
+        state.messages[data.type] = (state.messages[data.type] || 0) + 1;
+        return recv(conn, data);
+    };
+    state.peers.push({name: name, mocked: mocked});
+}
+done(state.peers.length);
+"""
+
+_connected_script = """
+return window.loadtest.peers.map((p) => p.mocked.client.connectionsMap.size);
+"""
+
+_post_script = """
+const [idx, contents, done] = arguments;
+window.loadtest.peers[idx].mocked.client
+    .postCB(contents, null)
+    .then((post) => done([post.desc.id, Date.now()]));
+"""
+
+_collect_script = """
+return {seen: window.loadtest.seen, messages: window.loadtest.messages};
+"""
+
+_teardown_script = """
+window.loadtest.peers.forEach((p) => p.mocked.client.destroy());
+"""
+
+
+def start_peers(pool, count, settings):
+    # Spreads `count` peers over the pool's browsers, returns (tab, index, name)
+    # for each peer.
+    tabs = len(pool.clients)
+    peers = []
+    for tab, client in enumerate(pool.clients):
+        names = [f"peer{i}" for i in range(tab, count, tabs)]
+        client.driver.get(f"https://localhost:{client.port}/dist/test/test.html")
+        wait_until(
+            lambda: client.driver.execute_script("return !!window.test"),
+            name="test page",
+        )
+        set_script_timeout(client.driver, 30 + 5 * len(names))
+        client.driver.execute_async_script(
+            "(async () => {" + _harness_script + "})()", settings, names
+        )
+        peers += [(tab, idx, name) for idx, name in enumerate(names)]
+    return peers
+
+
+def run_load(pool, args, settings):
+    peers = start_peers(pool, args.peers, settings)
+    print(f"Started {len(peers)} peer(s) in {len(pool.clients)} browser(s)")
+
+    def all_connected():
+        sizes = []
+        for client in pool.clients:
+            sizes += client.driver.execute_script(_connected_script)
+        return all(size > 0 for size in sizes)
+
+    wait_until(all_connected, name="peers connected", timeout=args.warmup)
+    print("All peers connected")
+
+    rng = random.Random(args.seed)
+    injected = dict()
+    start = time.time()
+    for i in range(args.posts):
+        delay = start + i / args.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        tab, idx, name = rng.choice(peers)
+        driver_ = pool.clients[tab].driver
+        postid, when = driver_.execute_async_script(_post_script, idx, f"post {i}")
+        injected[postid] = (name, when)
+    print(f"Injected {len(injected)} post(s) in {time.time() - start:.2f}s")
+
+    names = [name for (_, _, name) in peers]
+    expected = len(injected) * (len(names) - 1)
+
+    def collect():
+        seen = dict()
+        messages = dict()
+        for client in pool.clients:
+            state = client.driver.execute_script(_collect_script)
+            for postid, seen_at in state["seen"].items():
+                seen.setdefault(postid, {}).update(seen_at)
+            for msgtype, count in state["messages"].items():
+                messages[msgtype] = messages.get(msgtype, 0) + count
+        return seen, messages
+
+    def converged():
+        seen, _ = collect()
+        total = sum(len(seen.get(postid, {})) - 1 for postid in injected)
+        return total >= expected
+
+    try:
+        wait_until(converged, name="propagation", timeout=args.settle)
+    except TimeoutError as e:
+        print(e)
+    seen, messages = collect()
+
+    for client in pool.clients:
+        client.driver.execute_script(_teardown_script)
+
+    latencies = []
+    per_post = dict()
+    for postid, (author, injected_at) in injected.items():
+        delays = [
+            (seen_at - injected_at) / 1000
+            for (name, seen_at) in seen.get(postid, {}).items()
+            if name != author
+        ]
+        per_post[postid] = sorted(delays)
+        latencies += delays
+    latencies.sort()
+
+    return {
+        "peers": len(names),
+        "browsers": len(pool.clients),
+        "posts": len(injected),
+        "rate": args.rate,
+        "settings": settings,
+        "coverage": len(latencies) / expected if expected else 1,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+        # Time until the last peer saw each post
+        "full_propagation": {
+            postid: delays[-1] if len(delays) == len(names) - 1 else None
+            for postid, delays in per_post.items()
+        },
+        "messages": messages,
+        "messages_per_peer": {
+            msgtype: count / len(names) for msgtype, count in messages.items()
+        },
+    }
+
+
+def print_report(report):
+    def fmt(value):
+        return "n/a" if value is None else f"{value:.3f}s"
+
+    print("==============================")
+    print(
+        f"{report['posts']} post(s) at {report['rate']}/s "
+        f"to {report['peers']} peer(s)"
+    )
+    print(f"coverage: {report['coverage'] * 100:.1f}%")
+    for name, value in report["latency"].items():
+        print(f"    {name}: {fmt(value)}")
+    print("messages received (total, per peer):")
+    for msgtype, count in sorted(report["messages"].items()):
+        per_peer = report["messages_per_peer"][msgtype]
+        print(f"    {msgtype}: {count} ({per_peer:.1f})")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Measure post propagation across many simulated peers"
+    )
+    parser.add_argument("-n", "--peers", type=int, default=20)
+    parser.add_argument(
+        "-b", "--browsers", type=int, default=4, help="browsers to spread peers over"
+    )
+    parser.add_argument("--posts", type=int, default=20, help="posts to inject")
+    parser.add_argument("--rate", type=float, default=1, help="posts per second")
+    parser.add_argument(
+        "--settings",
+        type=json.loads,
+        default={},
+        help="JSON overrides for settings_dev.json, e.g. '{\"maxconnections\": 5}'",
+    )
+    parser.add_argument(
+        "--warmup", type=float, default=60, help="seconds to wait for connections"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=60, help="seconds to wait for propagation"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=driver.g_port)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+    if args.peers < 2:
+        parser.error("need at least 2 peers")
+
+    toplevel = subprocess.check_output(["git", "rev-parse", "--show-toplevel"])
+    os.chdir(toplevel.strip())
+    driver.setupEnvironment()
+
+    # Settings are applied when each mocked client is created, so the default
+    # build can be reused for any combination of overrides.
+    with TemporaryDirectory() as tempdir, driver.peerserver() as ps:
+        settings = dict(args.settings)
+        settings["peercloud"] = {
+            **settings.get("peercloud", {}),
+            **driver.peercloudOf(ps),
+        }
+        build_settings = driver.load_settings_json({})
+        with driver.buildTest(tempdir, True, build_settings):
+            with driver.server(tempdir, args.port):
+                with ClientPool(args.port, min(args.browsers, args.peers)) as pool:
+                    report = run_load(pool, args, settings)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
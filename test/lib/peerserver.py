@@ -0,0 +1,246 @@
+import asyncio
+import base64
+import hashlib
+import json
+import ssl
+import struct
+import threading
+import uuid
+
+from urllib.parse import parse_qs, urlsplit
+
+# Just enough of the PeerJS server protocol for the app's clients: id
+# assignment, the /peers discovery endpoint and relaying of signalling
+# messages over a websocket. Runs on its own event loop in a background thread.
+
+_ws_magic = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+_relayed = {"OFFER", "ANSWER", "CANDIDATE", "LEAVE", "EXPIRE"}
+
+
+class WebSocket:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def _read_frame(self):
+        header = await self.reader.readexactly(2)
+        fin = header[0] & 0x80
+        opcode = header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            (length,) = struct.unpack("!H", await self.reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack("!Q", await self.reader.readexactly(8))
+        mask = await self.reader.readexactly(4) if header[1] & 0x80 else None
+        payload = await self.reader.readexactly(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return fin, opcode, payload
+
+    async def recv(self):
+        # Returns the next text message, or None once the peer has closed
+        message = b""
+        while True:
+            fin, opcode, payload = await self._read_frame()
+            if opcode == OP_CLOSE:
+                await self.send(payload[:2], OP_CLOSE)
+                return None
+            if opcode == OP_PING:
+                await self.send(payload, OP_PONG)
+                continue
+            if opcode in (OP_TEXT, OP_CONTINUATION):
+                message += payload
+                if fin:
+                    return message.decode()
+
+    async def send(self, data, opcode=OP_TEXT):
+        if isinstance(data, str):
+            data = data.encode()
+        header = bytes([0x80 | opcode])
+        if len(data) < 126:
+            header += bytes([len(data)])
+        elif len(data) < (1 << 16):
+            header += bytes([126]) + struct.pack("!H", len(data))
+        else:
+            header += bytes([127]) + struct.pack("!Q", len(data))
+        self.writer.write(header + data)
+        await self.writer.drain()
+
+
+class PeerServer:
+    def __init__(self, port, certfile, path="peerserver", key="peerjs"):
+        self.port = port
+        self.certfile = certfile
+        self.prefix = f"/{path}/{key}"
+        self.clients = dict()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.started = threading.Event()
+
+    def _response(self, writer, status, body=b"", content_type="text/plain"):
+        if isinstance(body, str):
+            body = body.encode()
+        headers = [
+            f"HTTP/1.1 {status}",
+            "Access-Control-Allow-Origin: *",
+            "Access-Control-Allow-Headers: Content-Type",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            "Connection: close",
+        ]
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        lines = request.decode("latin-1").split("\r\n")
+        method, target, _ = lines[0].split(" ", 2)
+        headers = dict()
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+
+        try:
+            if headers.get("upgrade", "").lower() == "websocket":
+                await self._websocket(reader, writer, headers, parse_qs(url.query))
+            elif method == "OPTIONS":
+                self._response(writer, "204 No Content")
+            elif url.path == self.prefix + "/id":
+                self._response(writer, "200 OK", str(uuid.uuid4()))
+            elif url.path == self.prefix + "/peers":
+                body = json.dumps(list(self.clients))
+                self._response(writer, "200 OK", body, "application/json")
+            else:
+                self._response(writer, "404 Not Found")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Server shutdown, the connection just goes away
+            pass
+        finally:
+            writer.close()
+
+    async def _websocket(self, reader, writer, headers, query):
+        accept = base64.b64encode(
+            hashlib.sha1(headers["sec-websocket-key"].encode() + _ws_magic).digest()
+        ).decode()
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+            ).encode()
+        )
+        ws = WebSocket(reader, writer)
+
+        peerid = query.get("id", [""])[0]
+        token = query.get("token", [""])[0]
+        existing = self.clients.get(peerid)
+        if not peerid or (existing and existing[1] != token):
+            await ws.send(
+                json.dumps({"type": "ID-TAKEN", "payload": {"msg": "ID is taken"}})
+            )
+            return
+
+        self.clients[peerid] = (ws, token)
+        try:
+            await ws.send(json.dumps({"type": "OPEN"}))
+            while True:
+                raw = await ws.recv()
+                if raw is None:
+                    break
+                await self._relay(peerid, json.loads(raw))
+        finally:
+            if self.clients.get(peerid, (None,))[0] is ws:
+                del self.clients[peerid]
+
+    async def _relay(self, src, message):
+        msgtype = message.get("type")
+        if msgtype not in _relayed:
+            # HEARTBEAT and anything unknown
+            return
+        dst = message.get("dst")
+        target = self.clients.get(dst)
+        if target:
+            message["src"] = src
+            try:
+                await target[0].send(json.dumps(message))
+                return
+            except ConnectionError:
+                pass
+        if msgtype not in ("LEAVE", "EXPIRE"):
+            # Tell the sender right away that the peer is gone instead of
+            # queueing the message like the real server does.
+            await self.clients[src][0].send(
+                json.dumps({"type": "EXPIRE", "src": dst, "dst": src})
+            )
+
+    async def _serve(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certfile)
+        self.server = await asyncio.start_server(
+            self._handle, "localhost", self.port, ssl=context
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started.set()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        error = []
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(self._serve())
+            except asyncio.CancelledError:
+                pass
+            except OSError as e:
+                error.append(e)
+            finally:
+                self.started.set()
+                # Drop the connections that are still open
+                pending = asyncio.all_tasks(self.loop)
+                for task in pending:
+                    task.cancel()
+                self.loop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True)
+                )
+                self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if error:
+            # e.g. the port is already in use
+            raise error[0]
+        if not self.server:
+            raise RuntimeError(f"peerserver failed to start on port {self.port}")
+        return self
+
+    def stop(self):
+        if self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.thread.join(timeout=5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        self.stop()
@@ -0,0 +1,111 @@
+import json
+import os
+
+from selenium.common.exceptions import WebDriverException
+
+# Opt-in DevTools profiling of test clients (`test.py --profile DIR`). Browsers
+# started with `enable` record a timeline trace into their performance log,
+# and `start`/`stop` wrap a test in a sampling CPU profile. Both end up in one
+# JSON file per client per test that loads in the DevTools performance panel
+# or chrome://tracing.
+
+trace_categories = ",".join(
+    [
+        "devtools.timeline",
+        "disabled-by-default-devtools.timeline",
+        "v8.execute",
+        "blink.user_timing",
+    ]
+)
+# Microseconds between CPU profile samples
+sampling_interval = 100
+
+# Not real code, left out of the summary
+_ignored = {"(root)", "(idle)"}
+
+
+def enable(options, caps):
+    # Set up a new browser's options and capabilities for profiling
+    caps.setdefault("goog:loggingPrefs", {})["performance"] = "ALL"
+    options.add_experimental_option(
+        "perfLoggingPrefs",
+        {
+            "enableNetwork": False,
+            "enablePage": False,
+            "traceCategories": trace_categories,
+        },
+    )
+
+
+def _trace_events(driver):
+    events = []
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        if message["method"] == "Tracing.dataCollected":
+            events.append(message["params"])
+    return events
+
+
+def start(driver):
+    # Drop trace events from before the test
+    _trace_events(driver)
+    driver.execute_cdp_cmd("Profiler.enable", {})
+    driver.execute_cdp_cmd(
+        "Profiler.setSamplingInterval", {"interval": sampling_interval}
+    )
+    driver.execute_cdp_cmd("Profiler.start", {})
+
+
+def stop(driver):
+    # Returns the trace of everything since `start`
+    trace = {"traceEvents": _trace_events(driver)}
+    try:
+        trace["cpuProfile"] = driver.execute_cdp_cmd("Profiler.stop", {})["profile"]
+        driver.execute_cdp_cmd("Profiler.disable", {})
+    except WebDriverException:
+        # The renderer was replaced, e.g. by navigating to another site, which
+        # throws away the profile
+        trace["cpuProfile"] = None
+    return trace
+
+
+def save(trace, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(trace, f)
+
+
+def self_times(profile):
+    # {(function, location): milliseconds} of time spent in each function
+    # itself, not in the functions it called
+    if not profile:
+        return {}
+    nodes = {node["id"]: node for node in profile["nodes"]}
+    samples = profile.get("samples", [])
+    # A sample lasts until the next one is taken
+    deltas = profile.get("timeDeltas", [])[1:] + [0]
+    totals = dict()
+    for node_id, delta in zip(samples, deltas):
+        frame = nodes[node_id]["callFrame"]
+        name = frame["functionName"] or "(anonymous)"
+        if name in _ignored:
+            continue
+        location = ""
+        if frame["url"]:
+            location = f"{os.path.basename(frame['url'])}:{frame['lineNumber'] + 1}"
+        key = (name, location)
+        totals[key] = totals.get(key, 0) + delta / 1000
+    return totals
+
+
+def summary(trace, top=15):
+    # Lines of a report of the `top` functions by self time
+    totals = self_times(trace["cpuProfile"])
+    if not totals:
+        return ["no CPU profile"]
+    sampled = sum(totals.values())
+    lines = [f"{sampled:.1f}ms sampled", f"{'self ms':>9} {'%':>6}  function"]
+    for (name, location), ms in sorted(totals.items(), key=lambda i: -i[1])[:top]:
+        where = f" ({location})" if location else ""
+        lines.append(f"{ms:>9.1f} {ms / sampled * 100:>5.1f}%  {name}{where}")
+    return lines
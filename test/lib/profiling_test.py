@@ -0,0 +1,32 @@
+import profiling
+
+test_config = {"rebuild_required": False, "server_required": False}
+
+
+def frame(name, url="", line=0):
+    return {"functionName": name, "url": url, "lineNumber": line, "columnNumber": 0}
+
+
+def test_self_times(_testInput):
+    url = "https://localhost:8000/dist/index.js"
+    profile = {
+        "nodes": [
+            {"id": 1, "callFrame": frame("(root)"), "children": [2, 4]},
+            {"id": 2, "callFrame": frame("sign", url, 9), "children": [3]},
+            {"id": 3, "callFrame": frame("", url, 19)},
+            {"id": 4, "callFrame": frame("(idle)")},
+        ],
+        "samples": [2, 3, 2, 4, 3],
+        # Microseconds before each sample
+        "timeDeltas": [0, 1000, 2000, 3000, 4000],
+    }
+    times = profiling.self_times(profile)
+    assert times == {
+        ("sign", "index.js:10"): 1 + 3,
+        ("(anonymous)", "index.js:20"): 2 + 0,
+    }, times
+
+    lines = profiling.summary({"cpuProfile": profile}, top=1)
+    assert lines[0] == "6.0ms sampled", lines
+    assert len(lines) == 3 and lines[2].endswith("sign (index.js:10)"), lines
+    assert profiling.summary({"cpuProfile": None}) == ["no CPU profile"]
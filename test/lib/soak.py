@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from tempfile import TemporaryDirectory
+
+from selenium.common.exceptions import WebDriverException
+
+import driver
+
+from client import ClientPool
+
+# Keeps a few logged in browsers posting and syncing for a long time with all
+# of the app's intervals (and the post cache TTL) sped up, sampling memory,
+# DOM and storage use as it goes. Fails if any of them keeps growing faster
+# than its limit once the caches should have reached a steady state.
+
+# Allowed growth per minute of each metric, in bytes or nodes
+default_limits = {
+    "heap": 512 * 1024,
+    "dom_nodes": 50,
+    "listeners": 50,
+    "storage": 256 * 1024,
+}
+# Intervals aren't sped up below this many ms
+min_interval = 100
+
+_sample_script = """
+const done = arguments[arguments.length - 1];
+(async () => {
+    const estimate = navigator.storage ? await navigator.storage.estimate() : {};
+    const details = estimate.usageDetails || {};
+    done({
+        heap: performance.memory ? performance.memory.usedJSHeapSize : null,
+        dom_nodes: document.getElementsByTagName("*").length,
+        posts: document.querySelectorAll(".post").length,
+        storage: estimate.usage === undefined ? null : estimate.usage,
+        indexeddb: details.indexedDB === undefined ? null : details.indexedDB,
+    });
+})();
+"""
+
+
+def compress(settings, speedup):
+    # Settings overrides with every interval and the cache TTL divided by
+    # `speedup`
+    def scale(ms):
+        return max(min_interval, int(ms / speedup))
+
+    return {
+        "intervals": {k: scale(v) for k, v in settings["intervals"].items()},
+        "cachettl": scale(settings["cachettl"]),
+    }
+
+
+def sample(client):
+    values = client.driver.execute_async_script(_sample_script)
+    try:
+        # Precise numbers after a full GC, performance.memory is bucketed
+        client.driver.execute_cdp_cmd("HeapProfiler.collectGarbage", {})
+        usage = client.driver.execute_cdp_cmd("Runtime.getHeapUsage", {})
+        values["heap"] = usage["usedSize"]
+        client.driver.execute_cdp_cmd("Performance.enable", {})
+        metrics = client.driver.execute_cdp_cmd("Performance.getMetrics", {})
+        metrics = {m["name"]: m["value"] for m in metrics["metrics"]}
+        values["listeners"] = metrics.get("JSEventListeners")
+    except WebDriverException:
+        values["listeners"] = None
+    return values
+
+
+def slope(points):
+    # Least squares slope of [(x, y)]
+    n = len(points)
+    if n < 2:
+        return 0
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if not var:
+        return 0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+
+def check(samples, limits, settle):
+    # Returns the per client slopes (per minute) of every limited metric
+    # after `settle` seconds and the ones over their limit
+    slopes = dict()
+    failures = []
+    clients = sorted({s["client"] for s in samples})
+    for name, limit in sorted(limits.items()):
+        for idx in clients:
+            points = [
+                (s["t"] / 60, s[name])
+                for s in samples
+                if s["client"] == idx and s["t"] >= settle and s[name] is not None
+            ]
+            if len(points) < 3:
+                continue
+            value = slope(points)
+            slopes[f"client{idx}.{name}"] = value
+            if value > limit:
+                failures.append(
+                    f"client {idx} {name} grew by {value:.0f}/min (limit {limit})"
+                )
+    return slopes, failures
+
+
+def run_soak(pool, args, output):
+    for idx, client in enumerate(pool.clients):
+        client.login(f"soak{idx}")
+        client.waitForUserSetup()
+    print(f"Logged in {len(pool.clients)} client(s)")
+
+    samples = []
+    posts = 0
+    start = time.time()
+    next_post = [
+        start + idx * args.post_interval / len(pool.clients)
+        for idx in range(len(pool.clients))
+    ]
+    next_sample = start
+    while True:
+        now = time.time()
+        elapsed = now - start
+        if elapsed >= args.duration:
+            break
+        for idx, client in enumerate(pool.clients):
+            if now >= next_post[idx]:
+                client.newPost(f"soak post {posts} from soak{idx} %soak")
+                posts += 1
+                next_post[idx] += args.post_interval
+        if now >= next_sample:
+            for idx, client in enumerate(pool.clients):
+                record = {"t": elapsed, "client": idx, "created": posts}
+                record.update(sample(client))
+                samples.append(record)
+                output.write(json.dumps(record) + "\n")
+            output.flush()
+            latest = samples[-len(pool.clients) :]
+            print(
+                f"{elapsed:6.0f}s {posts} post(s) created, rendered "
+                + ", ".join(str(s["posts"]) for s in latest)
+            )
+            next_sample += args.sample_interval
+        time.sleep(max(0, min(next_post + [next_sample]) - time.time()))
+    return samples
+
+
+def parse_limit(value):
+    name, limit = value.split("=", 1)
+    if name not in default_limits:
+        raise argparse.ArgumentTypeError(f"unknown metric {name}")
+    return name, float(limit)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check that memory and storage stay bounded over a long run"
+    )
+    parser.add_argument("-n", "--clients", type=int, default=2)
+    parser.add_argument(
+        "--duration", type=float, default=600, help="seconds to run for"
+    )
+    parser.add_argument(
+        "--speedup",
+        type=float,
+        default=60,
+        help="divide the intervals in settings_dev.json and the cache TTL by this",
+    )
+    parser.add_argument(
+        "--post-interval",
+        type=float,
+        default=5,
+        help="seconds between posts per client",
+    )
+    parser.add_argument(
+        "--sample-interval", type=float, default=10, help="seconds between samples"
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        help="seconds before growth is checked (default: two cache TTLs)",
+    )
+    parser.add_argument(
+        "--limit",
+        type=parse_limit,
+        action="append",
+        default=[],
+        metavar="METRIC=VALUE",
+        help="allowed growth per minute, one of " + ", ".join(default_limits),
+    )
+    parser.add_argument("--output", default="soak.jsonl", help="time series file")
+    parser.add_argument("--port", type=int, default=driver.g_port)
+    args = parser.parse_args(argv)
+    limits = dict(default_limits, **dict(args.limit))
+    output_path = os.path.realpath(args.output)
+
+    toplevel = subprocess.check_output(["git", "rev-parse", "--show-toplevel"])
+    os.chdir(toplevel.strip())
+    driver.setupEnvironment()
+
+    with open("src/settings/settings_dev.json") as f:
+        overrides = compress(json.load(f), args.speedup)
+    settle = args.settle
+    if settle is None:
+        settle = 2 * overrides["cachettl"] / 1000
+    print(f"Soaking for {args.duration:.0f}s with {json.dumps(overrides)}")
+
+    with TemporaryDirectory() as tempdir, driver.peerserver() as ps:
+        settings = driver.load_settings_json({"settings_json": overrides})
+        peercloud = {"peercloud": driver.peercloudOf(ps)}
+        with driver.buildTest(tempdir, True, settings, peercloud):
+            with driver.server(tempdir, args.port):
+                with ClientPool(args.port, args.clients) as pool:
+                    with open(output_path, "w") as output:
+                        samples = run_soak(pool, args, output)
+
+    slopes, failures = check(samples, limits, settle)
+    print("==============================")
+    print(f"Wrote {len(samples)} sample(s) to {output_path}")
+    print(f"growth per minute after {settle:.0f}s:")
+    for name, value in sorted(slopes.items()):
+        print(f"    {name}: {value:.1f}")
+    if failures:
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print("Everything stayed within its limits")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,30 @@
+import soak
+
+test_config = {"rebuild_required": False, "server_required": False}
+
+
+def test_compress(_testInput):
+    settings = {"intervals": {"poll": 60000, "fast": 1000}, "cachettl": 3600000}
+    overrides = soak.compress(settings, 60)
+    assert overrides == {
+        "intervals": {"poll": 1000, "fast": soak.min_interval},
+        "cachettl": 60000,
+    }, overrides
+
+
+def test_check(_testInput):
+    samples = []
+    for minute in range(10):
+        for client in range(2):
+            samples.append(
+                {
+                    "t": minute * 60,
+                    "client": client,
+                    # Client 1 leaks a node every second after settling
+                    "dom_nodes": 100 + (60 * minute if client and minute > 2 else 0),
+                    "heap": None,
+                }
+            )
+    slopes, failures = soak.check(samples, {"dom_nodes": 50, "heap": 1}, 180)
+    assert slopes == {"client0.dom_nodes": 0, "client1.dom_nodes": 60}, slopes
+    assert failures == ["client 1 dom_nodes grew by 60/min (limit 50)"], failures
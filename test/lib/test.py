@@ -1,36 +1,262 @@
 #!/usr/bin/env python3
-import importlib.util
+import argparse
+import json
+import multiprocessing
 import os
 import subprocess
 import sys
+import tempfile
+import time
+import traceback
+import xml.etree.ElementTree as ET
 
-from driver import main
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
 
+import driver
 
-def get_all_tests():
-    tests = subprocess.check_output(["find", "test/", "-name", "*_test.py"])
-    tests = tests.strip().decode().split("\n")
-    return tests
+from collect import collect, find_modules, load_module, parse_shard, select
 
+# Wall time of each module's last run, used to start the slowest ones first
+timings_file = ".test_timings.json"
+# Every worker gets its own block of server ports starting at this offset
+port_range = 100
 
-def load_module(fullpath):
-    module = os.path.basename(fullpath).rsplit(".", 1)[0]
-    spec = importlib.util.spec_from_file_location(module, fullpath)
-    lib = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(lib)
-    return lib
+
+def load_timings():
+    try:
+        with open(timings_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_timings(timings):
+    with open(timings_file, "w") as f:
+        json.dump(timings, f, indent=4, sort_keys=True)
+
+
+def _init_worker(slots, tmproot, profile, profile_top):
+    slot = slots.get()
+    driver.g_port += slot * port_range
+    driver.g_profile = profile
+    driver.g_profile_top = profile_top
+    tempfile.tempdir = os.path.join(tmproot, f"worker{slot}")
+    os.makedirs(tempfile.tempdir)
+
+
+def _run_module(path, capture, selection):
+    driver.g_metrics = driver.Metrics(None)
+    start = time.time()
+    log = tempfile.NamedTemporaryFile("w+", suffix=".log") if capture else None
+    try:
+        failures = None
+        try:
+            if capture:
+                with redirect_stdout(log), redirect_stderr(log):
+                    failures = driver.runModule(load_module(path), selection)
+            else:
+                failures = driver.runModule(load_module(path), selection)
+        except BaseException:
+            if capture:
+                traceback.print_exc(file=log)
+            else:
+                traceback.print_exc()
+            failures = [("<module>", time.time() - start)]
+
+        output = None
+        if capture:
+            log.seek(0)
+            output = log.read()
+        metrics = driver.g_metrics.toJson()
+        metrics["path"] = path
+        return path, failures, time.time() - start, output, metrics
+    finally:
+        if log:
+            log.close()
+
+
+def write_metrics(filename, results):
+    # One JSON object per module and one per test
+    with open(filename, "w") as f:
+        for path, failures, elapsed, metrics in results:
+            for test in metrics["tests"]:
+                record = {"type": "test", "path": path, **test}
+                f.write(json.dumps(record) + "\n")
+            record = {
+                "type": "module",
+                "path": path,
+                "module": metrics["module"],
+                "elapsed": elapsed,
+                "failed": bool(failures),
+                "phases": metrics["phases"],
+                "info": metrics["info"],
+            }
+            f.write(json.dumps(record) + "\n")
+
+
+def write_junit(filename, results):
+    testsuites = ET.Element("testsuites")
+    for path, failures, elapsed, metrics in results:
+        tests = metrics["tests"]
+        testsuite = ET.SubElement(
+            testsuites,
+            "testsuite",
+            name=metrics["module"] or path,
+            file=path,
+            tests=str(len(tests)),
+            failures=str(len(failures)),
+            time=f"{elapsed:.3f}",
+        )
+        properties = ET.SubElement(testsuite, "properties")
+        for phase, value in sorted(metrics["phases"].items()):
+            ET.SubElement(
+                properties, "property", name=f"phase.{phase}", value=f"{value:.3f}"
+            )
+        for key, value in sorted(metrics["info"].items()):
+            ET.SubElement(properties, "property", name=key, value=str(value))
+
+        for test in tests:
+            testcase = ET.SubElement(
+                testsuite,
+                "testcase",
+                classname=metrics["module"] or path,
+                name=test["name"],
+                time=f"{test['body']:.3f}",
+            )
+            properties = ET.SubElement(testcase, "properties")
+            for key in ["clients", "lease", "reset", "waits", "polls", "retries"]:
+                ET.SubElement(properties, "property", name=key, value=str(test[key]))
+            if not test["passed"]:
+                failure = ET.SubElement(testcase, "failure", message=test["error"])
+                failure.text = test["stdout"]
+        if any(f[0] == "<module>" for f in failures):
+            # The module itself blew up before or after its tests
+            testcase = ET.SubElement(
+                testsuite, "testcase", classname=path, name="<module>"
+            )
+            ET.SubElement(testcase, "error", message="module failed, see the log")
+    ET.ElementTree(testsuites).write(filename, encoding="utf-8", xml_declaration=True)
 
 
 def _run_tests(argv):
+    parser = argparse.ArgumentParser(description="Run the end-to-end tests")
+    parser.add_argument("tests", nargs="*", help="test files to run (default: all)")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of test modules to run in parallel "
+        "(default: number of CPUs, 1 with --bench)",
+    )
+    parser.add_argument(
+        "--bench",
+        action="store_true",
+        help="run the *_bench.py benchmarks instead of the tests",
+    )
+    parser.add_argument(
+        "--metrics", help="write per module and per test timings as JSON Lines"
+    )
+    parser.add_argument("--junit", help="write a JUnit XML report")
+    parser.add_argument(
+        "-k", dest="keyword", help="only run tests whose module:name contains this"
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="i/n: only run the i-th of n roughly equal parts of the tests",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="save a DevTools trace and CPU profile of every client in every "
+        "test to DIR and print where the time went",
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=15,
+        help="functions to list in each profile summary",
+    )
+    args = parser.parse_args(argv)
+    paths = [os.path.realpath(p) for p in args.tests]
+    outputs = [
+        os.path.realpath(f) if f else None
+        for f in [args.metrics, args.junit, args.profile]
+    ]
+    if args.jobs is None:
+        # Benchmarks running side by side would skew each other's timings
+        args.jobs = 1 if args.bench else os.cpu_count() or 1
+
     toplevel = subprocess.check_output(["git", "rev-parse", "--show-toplevel"])
     os.chdir(toplevel.strip())
 
-    if len(argv) == 0:
-        argv += get_all_tests()
+    pattern = "*_bench.py" if args.bench else "*_test.py"
+    paths = [os.path.relpath(p) for p in paths or find_modules(pattern)]
+    selected = select(collect(paths), args.keyword, args.shard)
+    partial = bool(args.keyword or args.shard)
+    paths = list(selected)
+    if not paths:
+        print("No tests selected")
+        return
+
+    # Start the longest running modules first, unknown ones are assumed slow
+    timings = load_timings()
+    paths.sort(key=lambda p: -timings.get(p, float("inf")))
+
+    jobs = max(1, min(args.jobs, len(paths)))
+    # Interleaved output from several modules is unreadable, so when running
+    # in parallel each module's output is buffered and printed once it's done.
+    capture = jobs > 1
+
+    start = time.time()
+    results = []
+    context = multiprocessing.get_context("spawn")
+    slots = context.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+    with tempfile.TemporaryDirectory(prefix="ephemeral-test-") as tmproot:
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(slots, tmproot, outputs[2], args.profile_top),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _run_module, p, capture, selected[p] if partial else None
+                )
+                for p in paths
+            ]
+            for future in as_completed(futures):
+                path, failures, elapsed, output, metrics = future.result()
+                if output is not None:
+                    print(f"============ {path} ============")
+                    print(output, end="")
+                if not partial:
+                    timings[path] = elapsed
+                results.append((path, failures, elapsed, metrics))
+    wall = time.time() - start
+    save_timings(timings)
+    results.sort(key=lambda r: r[0])
+    metrics_file, junit_file, _ = outputs
+    if metrics_file:
+        write_metrics(metrics_file, results)
+    if junit_file:
+        write_junit(junit_file, results)
 
-    for arg in argv:
-        path = os.path.realpath(arg)
-        main(load_module(path))
+    print("==============================")
+    print(f"Ran {len(results)} module(s) on {jobs} worker(s) in {wall:.2f}s")
+    failed = False
+    for path, failures, elapsed, _ in results:
+        status = "FAILED" if failures else "passed"
+        print(f"    {path} {status} ({elapsed:.2f}s)")
+        for failure in failures:
+            print("        ", failure[0], failure[1])
+        failed = failed or bool(failures)
+    if failed:
+        sys.exit(1)
+    print("All modules passed!")
 
 
 if __name__ == "__main__":
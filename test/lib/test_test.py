@@ -1,13 +1,27 @@
 import subprocess
 
+import collect
 import test
 
 test_config = {"server_required": False}
 
 
-def test_get_all_tests(_testInput):
-    all_tests = test.get_all_tests()
-    assert "test//lib/test_test.py" in all_tests, all_tests
+def test_find_modules(_testInput):
+    all_tests = collect.find_modules()
+    assert "test/lib/test_test.py" in all_tests, all_tests
+
+
+def test_select_shards(_testInput):
+    modules = collect.collect(["test/lib/test_test.py"])
+    tests = modules["test/lib/test_test.py"]["tests"]
+    assert len(tests) == 4, tests
+
+    shards = [collect.select(modules, shard=(i, 3)) for i in range(1, 4)]
+    selected = [name for shard in shards for names in shard.values() for name in names]
+    assert sorted(selected) == sorted(t["name"] for t in tests), selected
+
+    only = collect.select(modules, keyword="test_test:test_load")
+    assert only == {"test/lib/test_test.py": ["test_load_module"]}, only
 
 
 some_value = 123
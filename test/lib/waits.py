@@ -0,0 +1,227 @@
+import socket
+import threading
+import time
+
+from selenium.common.exceptions import TimeoutException
+
+
+class AdaptiveTimeout:
+    # Learns how long a kind of wait usually takes. Until something has been
+    # observed the ceiling is used; afterwards the timeout is a multiple of the
+    # slowest recent observation, so a hung condition fails fast instead of
+    # always waiting out the worst case.
+    def __init__(self, floor, ceiling, factor=4, history=20):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.factor = factor
+        self.history = history
+        self.samples = []
+        self.lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        with self.lock:
+            if not self.samples:
+                return self.ceiling
+            slowest = max(self.samples)
+        return min(self.ceiling, max(self.floor, self.factor * slowest))
+
+    def record(self, elapsed):
+        with self.lock:
+            self.samples.append(elapsed)
+            del self.samples[: -self.history]
+
+
+_timeouts = dict()
+_timeouts_lock = threading.Lock()
+
+# Per thread number of waits and of condition evaluations, reported per test
+# by the driver
+_counters = threading.local()
+
+
+def _count(name):
+    setattr(_counters, name, getattr(_counters, name, 0) + 1)
+
+
+def take_counters():
+    counters = {
+        "waits": getattr(_counters, "waits", 0),
+        "polls": getattr(_counters, "polls", 0),
+    }
+    _counters.waits = 0
+    _counters.polls = 0
+    return counters
+
+
+# Never less than the 10s the fixed sleep/poll loops these waits replaced
+# allowed, so one fast observation can't make a loaded machine time out
+default_floor = 10
+default_ceiling = 60
+# What WebDriver starts with, selenium 3 can't read the current value back
+default_script_timeout = 30
+
+
+def adaptive_timeout(name, floor=default_floor, ceiling=default_ceiling):
+    # Shared by every wait with that name in the process, so the name should
+    # say what's being waited for, e.g. which test file or kind of login
+    with _timeouts_lock:
+        if name not in _timeouts:
+            _timeouts[name] = AdaptiveTimeout(floor, ceiling)
+        return _timeouts[name]
+
+
+def _resolve(name, timeout):
+    if timeout is not None:
+        return None, timeout
+    timer = adaptive_timeout(name)
+    return timer, timer.timeout
+
+
+def wait_until(condition, name="condition", timeout=None, message=""):
+    # Polls `condition` with exponential backoff (10ms up to 250ms) and returns
+    # its first truthy result.
+    timer, timeout = _resolve(name, timeout)
+    _count("waits")
+    start = time.time()
+    delay = 0.01
+    while True:
+        _count("polls")
+        result = condition()
+        elapsed = time.time() - start
+        if result:
+            if timer:
+                timer.record(elapsed)
+            return result
+        if elapsed >= timeout:
+            raise TimeoutError(f"{name} not met after {timeout:.1f}s. {message}")
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, 0.25)
+
+
+def wait_for_port(host, port, proc=None, timeout=None, name="port"):
+    # Waits until something accepts connections on (host, port). If the
+    # process that should be listening exits first, fail immediately.
+    def probe():
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"Process exited with {proc.returncode}")
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            return False
+
+    return wait_until(probe, name=name, timeout=timeout)
+
+
+def set_script_timeout(driver, seconds):
+    # Remembered so that it can be restored
+    driver.set_script_timeout(seconds)
+    driver.script_timeout = seconds
+
+
+def wait_for_dom(driver, js_condition, name="dom condition", timeout=None):
+    # Event-driven wait on the page: `js_condition` is the body of a function
+    # that is re-evaluated on every DOM mutation until it returns a truthy
+    # value, which is returned.
+    timer, timeout = _resolve(name, timeout)
+    _count("waits")
+    _count("polls")
+    start = time.time()
+    previous = getattr(driver, "script_timeout", default_script_timeout)
+    set_script_timeout(driver, timeout)
+    try:
+        result = driver.execute_async_script(
+            """
+            const condition = new Function(arguments[0]);
+            const done = arguments[arguments.length - 1];
+            const initial = condition();
+            if (initial) {
+                done(initial);
+                return;
+            }
+            const observer = new MutationObserver(() => {
+                const result = condition();
+                if (result) {
+                    observer.disconnect();
+                    done(result);
+                }
+            });
+            observer.observe(document, {
+                attributes: true,
+                characterData: true,
+                childList: true,
+                subtree: true,
+            });
+            """,
+            js_condition,
+        )
+    except TimeoutException:
+        raise TimeoutError(f"{name} not met after {timeout:.1f}s")
+    finally:
+        set_script_timeout(driver, previous)
+    if timer:
+        timer.record(time.time() - start)
+    return result
+
+
+class LogStream:
+    # Pushes every browser log entry of `client` to `callback` from a
+    # background thread until stopped.
+    def __init__(self, client, callback, interval=0.05):
+        self.client = client
+        self.callback = callback
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            for log in self.client.get_logs():
+                self.callback(log)
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        self.stop()
+
+
+def wait_for_log(client, predicate, name="log", timeout=None, on_log=None):
+    # Returns the first browser log entry for which `predicate` holds. Every
+    # entry seen is also handed to `on_log`, on the calling thread once the
+    # wait is over so that what it prints is captured with the test's output.
+    timer, timeout = _resolve(name, timeout)
+    _count("waits")
+    found = []
+    seen = []
+    event = threading.Event()
+
+    def callback(log):
+        # Runs on the LogStream's thread
+        seen.append(log)
+        if not found and predicate(log):
+            found.append(log)
+            event.set()
+
+    start = time.time()
+    with LogStream(client, callback):
+        event_set = event.wait(timeout)
+    _counters.polls = getattr(_counters, "polls", 0) + len(seen)
+    if on_log:
+        for log in seen:
+            on_log(log)
+    if not event_set:
+        raise TimeoutError(f"{name} not seen after {timeout:.1f}s")
+    if timer:
+        timer.record(time.time() - start)
+    return found[0]
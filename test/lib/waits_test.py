@@ -0,0 +1,62 @@
+import socket
+import time
+
+import waits
+
+test_config = {"rebuild_required": False, "server_required": False}
+
+
+def test_wait_until_returns_first_truthy_result(_testInput):
+    calls = []
+
+    def condition():
+        calls.append(None)
+        return len(calls) >= 3 and "done"
+
+    assert waits.wait_until(condition, timeout=1) == "done"
+    assert len(calls) == 3, calls
+
+
+def test_wait_until_times_out(_testInput):
+    start = time.time()
+    try:
+        waits.wait_until(lambda: False, timeout=0.2)
+    except TimeoutError:
+        pass
+    else:
+        assert False, "Expected a timeout"
+    assert time.time() - start < 1
+
+
+def test_adaptive_timeout_tracks_observations(_testInput):
+    timer = waits.AdaptiveTimeout(floor=1, ceiling=30)
+    assert timer.timeout == 30
+    timer.record(0.1)
+    assert timer.timeout == 1
+    timer.record(2)
+    assert timer.timeout == 8
+
+
+def test_wait_for_port(_testInput):
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+        assert waits.wait_for_port("localhost", port, timeout=1)
+
+
+class FakeDriver:
+    def __init__(self):
+        self.timeouts = []
+
+    def set_script_timeout(self, seconds):
+        self.timeouts.append(seconds)
+
+    def execute_async_script(self, script, *args):
+        return "done"
+
+
+def test_wait_for_dom_restores_script_timeout(_testInput):
+    driver = FakeDriver()
+    assert waits.wait_for_dom(driver, "return true;", timeout=3) == "done"
+    assert driver.timeouts == [3, waits.default_script_timeout], driver.timeouts
@@ -0,0 +1,190 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+
+from tempfile import TemporaryDirectory
+
+# The webhook's modules import each other by name, like when server.py runs
+sys.path.insert(0, os.path.join(os.getcwd(), "webhook"))
+import pipeline
+import releases
+
+test_config = {"rebuild_required": False, "server_required": False}
+
+
+def test_deploy_queue_coalesces(_testInput):
+    queue = pipeline.DeployQueue(lambda job: None)
+    assert not queue.submit("main", "b" * 40, "a" * 40, ["src/a.ts"])
+    assert queue.submit("main", "c" * 40, "b" * 40, ["README.md", "src/a.ts"])
+    other = queue.submit("other", "d" * 40)
+    assert not other
+
+    main, other = queue.pending.values()
+    # The push it started from is the first queued one's
+    assert main["commit"] == "c" * 40 and main["before"] == "a" * 40, main
+    assert main["paths"] == ["README.md", "src/a.ts"], main
+    assert other["commit"] == "d" * 40, other
+
+    # An unknown file list makes the whole batch unknown
+    queue.submit("main", "e" * 40, "c" * 40, None)
+    queue.submit("main", "f" * 40, "e" * 40, ["src/b.ts"])
+    assert queue.pending["main"]["paths"] is None, queue.pending["main"]
+    assert queue.pending["main"]["before"] == "a" * 40
+
+
+def wait_for_jobs(queue, count, timeout=5):
+    deadline = time.time() + timeout
+    while len(queue.recent) < count:
+        assert time.time() < deadline, queue.status()
+        time.sleep(0.01)
+
+
+def test_deploy_queue_runs_one_at_a_time(_testInput):
+    started = threading.Event()
+    release = threading.Event()
+    done = []
+
+    def deploy(job):
+        if not done:
+            started.set()
+            release.wait(5)
+        done.append(job["commit"])
+        if job["commit"] == "bad":
+            raise RuntimeError("build failed")
+
+    queue = pipeline.DeployQueue(deploy).start()
+    queue.submit("main", "1")
+    assert started.wait(5)
+    # Queued behind the running deploy, the second replaces the first
+    assert not queue.submit("main", "bad")
+    assert queue.submit("main", "2")
+    queue.rollback()
+    assert queue.status()["running"]["commit"] == "1"
+    release.set()
+
+    wait_for_jobs(queue, 3)
+    assert done == ["1", "2", None], done
+    assert [job["ok"] for job in queue.recent] == [True, True, True]
+    assert queue.recent[-1]["action"] == "rollback"
+
+    # A failed deploy doesn't stop the queue
+    queue.submit("main", "bad")
+    queue.submit("other", "3")
+    wait_for_jobs(queue, 5)
+    assert [job["ok"] for job in queue.recent][3:] == [False, True]
+
+
+def test_affects_build(_testInput):
+    assert pipeline.affects_build(["src/components/post.tsx"])
+    assert pipeline.affects_build(["README.md", "package.json"])
+    assert not pipeline.affects_build(["README.md", "test/lib/driver.py"])
+    # Directories match by prefix, files exactly
+    assert not pipeline.affects_build(["srcs/a.ts", "build.py.orig"])
+    assert not pipeline.affects_build([])
+
+
+def test_payload_paths(_testInput):
+    commits = [
+        {"added": ["src/a.ts"], "modified": ["README.md"], "removed": []},
+        {"added": [], "modified": ["src/a.ts"], "removed": ["test/old.py"]},
+    ]
+    paths = pipeline.payload_paths({"commits": commits})
+    assert paths == ["README.md", "src/a.ts", "test/old.py"], paths
+
+    # Whenever the payload may not list every change, git has to be asked
+    assert pipeline.payload_paths({"commits": commits, "forced": True}) is None
+    assert pipeline.payload_paths({"commits": []}) is None
+    truncated = commits * (pipeline.max_payload_commits // 2)
+    assert pipeline.payload_paths({"commits": truncated}) is None
+
+
+def test_valid_signature(_testInput):
+    body = b'{"ref": "refs/heads/main"}'
+    digest = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    assert pipeline.valid_signature(b"secret", body, f"sha256={digest}")
+    assert not pipeline.valid_signature(b"secret", body + b" ", f"sha256={digest}")
+    assert not pipeline.valid_signature(b"other", body, f"sha256={digest}")
+    assert not pipeline.valid_signature(b"secret", body, digest)
+    assert not pipeline.valid_signature(b"secret", body, "")
+    # Unset, every request is refused
+    assert not pipeline.valid_signature(b"", body, "sha256=")
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def test_release_check(_testInput):
+    with TemporaryDirectory() as release:
+        page = '<link href="./style.1234567890.css"><a href="https://x.org/">'
+        write(os.path.join(release, "index.html"), page)
+        write(os.path.join(release, "style.1234567890.css"), "a {}")
+        manifest = {"style.css": "style.1234567890.css"}
+        write(os.path.join(release, "manifest.json"), json.dumps(manifest))
+        assert releases.check(release) == []
+
+        manifest["index.js"] = "index.0123456789.js"
+        write(os.path.join(release, "manifest.json"), json.dumps(manifest))
+        write(os.path.join(release, "style.1234567890.css"), "")
+        errors = releases.check(release)
+        assert errors == [
+            "./style.1234567890.css from index.html is empty",
+            "style.1234567890.css from manifest.json is empty",
+            "index.0123456789.js from manifest.json is missing",
+        ], errors
+
+        os.remove(os.path.join(release, "index.html"))
+        assert releases.check(release)[0] == "index.html is missing"
+
+
+def test_releases(_testInput):
+    old = releases.releases_dir, releases.live_link
+    with TemporaryDirectory() as tempdir:
+        releases.releases_dir = os.path.join(tempdir, "releases")
+        releases.live_link = os.path.join(tempdir, "live")
+        try:
+            names = ["20260101T000000-aaaa", "20260102T000000-bbbb"]
+            for name in names + [".20260103T000000-cccc"]:
+                os.makedirs(os.path.join(releases.releases_dir, name))
+            # Unfinished builds are hidden
+            assert releases.list_releases() == names
+
+            # What an older index.html may still ask for
+            release = os.path.join(releases.releases_dir, names[0])
+            manifest = {"index.js": "index.0123456789.js", "a.css": "a.1234567890.css"}
+            write(os.path.join(release, "manifest.json"), json.dumps(manifest))
+            write(os.path.join(release, "index.0123456789.js"), "1")
+            write(os.path.join(release, "index.0123456789.js.gz"), "1")
+            hashed = releases.hashed_files(names[0])
+            assert hashed == ["index.0123456789.js", "index.0123456789.js.gz"]
+            assert releases.hashed_files(names[1]) == []
+
+            releases.activate(names[1])
+            assert releases.current() == names[1]
+            releases.rollback(None)
+            assert releases.current() == names[0]
+            releases.prune(0)
+            assert releases.list_releases() == [names[0]]
+            assert os.listdir(releases.releases_dir) == [names[0]]
+
+            # Names that would leave releases/ are refused
+            for name in ["..", "../live", "a/b", "/tmp", ""]:
+                try:
+                    releases._release_path(name)
+                except SystemExit:
+                    continue
+                assert False, name
+            os.symlink(tempdir, os.path.join(releases.releases_dir, "escape"))
+            try:
+                releases._release_path("escape")
+                assert False, "escape"
+            except SystemExit:
+                pass
+        finally:
+            releases.releases_dir, releases.live_link = old
@@ -1,5 +1,8 @@
 from driver import requiresClients, main
 
+# Every test logs into its own browser, so they can all run at once
+test_config = {"parallel_tests": 3}
+
 
 @requiresClients(1)
 def testGuestLogin(testInput):
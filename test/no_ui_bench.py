@@ -0,0 +1,36 @@
+import glob
+import os
+
+import bench
+
+from driver import main
+from jssuite import generateJsTest, verifyTest
+
+test_config = {
+    # Benchmarks don't talk to other peers
+    "local_peerserver": False,
+    # Print the reports of passing benchmarks too
+    "verbose": True,
+}
+
+testList = []
+
+
+def verifyBench(client, path):
+    results = dict()
+
+    def on_log(log):
+        sample = bench.parse_sample(log)
+        if sample:
+            results[sample["name"]] = bench.summarize(sample["samples"])
+
+    # Benchmarks take a lot longer than the js tests
+    verifyTest(client, path, on_log=on_log, timeout=300)
+    bench.check(os.path.basename(path), results)
+
+
+for path in sorted(glob.glob("test/js/**/*Bench.js", recursive=True)):
+    testList.append(generateJsTest(path, verifyBench))
+
+if __name__ == "__main__":
+    main(__name__)
@@ -1,5 +1,3 @@
-from time import sleep
-
 from driver import requiresClients, main
 
 test_config = {
@@ -41,18 +39,8 @@ def testPostsAreVisibleToOthers(testInput):
     guest1.login("guest1")
     guest1.waitForUserSetup()
 
-    max_retries = 10
-    found = False
-    while max_retries:
-        max_retries -= 1
-        posts = guest1.getPosts()
-        if len(posts) == 0:
-            print("Could not find any posts!")
-        else:
-            found = True
-            break
-        sleep(1)
-    assert found
+    guest1.waitForPosts()
+    posts = guest1.getPosts()
 
     posts = list(posts.values())
 
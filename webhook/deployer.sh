@@ -1,3 +1,4 @@
 set -ex
 
-su pi -c "bash -i webhook/do_deploy.sh"
+# The values stay in the environment, never in the command string
+su pi -w DEPLOY_ACTION,DEPLOY_BRANCH,DEPLOY_COMMIT,DEPLOY_RELEASE -c 'bash webhook/do_deploy.sh'
@@ -1,22 +1,54 @@
 set -ex
 
-git pull
+# Not an interactive shell, so nothing from ~/.bashrc: find webpack and sass in
+# the checkout
+export PATH="$PWD/node_modules/.bin:$PATH"
 
-npm run build_release
+if [ "$DEPLOY_ACTION" = rollback ]; then
+    # Back to $DEPLOY_RELEASE, or the release before the live one
+    python3 webhook/releases.py rollback ${DEPLOY_RELEASE:+"$DEPLOY_RELEASE"}
+else
+    git pull
 
-rm -rf ephemeral-live
-git clone https://github.com/aneeshdurg/ephemeral ephemeral-live
+    # Built into a new directory under releases/, seeded from the live release
+    # so the asset sync and webpack stay incremental. live/ is only switched
+    # over once the build succeeded and everything index.html references is
+    # there.
+    python3 webhook/releases.py deploy "${DEPLOY_COMMIT:-$(git rev-parse HEAD)}"
+fi
+# Resolved once, so a later switch can't change what's being published
+LIVE=$(readlink -f live)
 
-pushd ephemeral-live
-git remote set-url origin git@github.com:aneeshdurg/ephemeral
-git checkout gh-pages
+# The published site is kept checked out between deploys so that only the
+# files that changed are rewritten, committed and pushed.
+if [ ! -d ephemeral-live ]; then
+    git clone --branch gh-pages https://github.com/aneeshdurg/ephemeral ephemeral-live
+    git -C ephemeral-live remote set-url origin git@github.com:aneeshdurg/ephemeral
+fi
 
-rm -r *
-cp -r ../dist/* .
+pushd ephemeral-live
+git fetch origin gh-pages
+git reset --hard origin/gh-pages
+git clean -fdx
 
-git add .
-git commit -m Updates --allow-empty
-git push origin gh-pages
+# The asset sync's bookkeeping isn't part of the site
+rsync --recursive --checksum --delete --exclude .git --exclude .sync_manifest.json \
+    "$LIVE/" .
+rm -f .sync_manifest.json
 popd
 
-rm -rf ephemeral-live
+# Pages and browsers keep serving an older index.html for a while after the
+# push, so the hashed files that the other kept releases reference stay
+# published until those releases are pruned
+for release in $(python3 webhook/releases.py kept); do
+    python3 webhook/releases.py hashed "$release" |
+        rsync --ignore-existing --files-from=- "releases/$release/" ephemeral-live/
+done
+
+pushd ephemeral-live
+git add --all
+if ! git diff --cached --quiet; then
+    git commit -m "Deploy $(basename "$LIVE")"
+    git push origin gh-pages
+fi
+popd
@@ -0,0 +1,145 @@
+import hashlib
+import hmac
+import logging
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+import releases
+
+# Kept apart from server.py, which needs Flask, so that it can be tested on
+# its own
+log = logging.getLogger(__name__)
+
+# Paths (directories end in /) that end up in the published site. Pushes that
+# only touch other files, like tests or docs, don't need a deploy.
+build_inputs = [
+    "src/",
+    "build.py",
+    "webpack.config.js",
+    "tsconfig.json",
+    "package.json",
+    "package-lock.json",
+]
+# GitHub lists at most this many commits in a push payload
+max_payload_commits = 20
+
+
+class DeployQueue:
+    # Deploys run one at a time on a background thread. A push to a branch
+    # that's already waiting replaces the queued commit, so only the latest
+    # one gets deployed.
+    def __init__(self, deploy, history=20):
+        self.deploy = deploy
+        self.pending = OrderedDict()
+        self.running = None
+        self.recent = deque(maxlen=history)
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, branch, commit, before=None, paths=None):
+        # Returns whether the push was merged into an already queued deploy.
+        # `before` is the commit the push started from and `paths` the files
+        # it changed, if known.
+        with self.cond:
+            queued = self.pending.get(branch)
+            if queued:
+                before = queued["before"]
+                if queued["paths"] is None or paths is None:
+                    paths = None
+                else:
+                    paths = sorted(set(queued["paths"]) | set(paths))
+            self.pending[branch] = {
+                "action": "deploy",
+                "branch": branch,
+                "commit": commit,
+                "before": before,
+                "paths": paths,
+                "queued": time.time(),
+            }
+            self.cond.notify()
+        return queued is not None
+
+    def rollback(self, release=None):
+        # Switches back to `release`, or the one before the live release, after
+        # the deploys queued so far
+        with self.cond:
+            self.pending["rollback"] = {
+                "action": "rollback",
+                "branch": None,
+                "commit": release,
+                "queued": time.time(),
+            }
+            self.cond.notify()
+
+    def status(self):
+        with self.cond:
+            return {
+                "queued": len(self.pending),
+                "pending": list(self.pending.values()),
+                "running": self.running,
+                "recent": list(self.recent),
+                "live": releases.current(),
+                "releases": releases.list_releases(),
+            }
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending)
+                _, job = self.pending.popitem(last=False)
+                job["started"] = time.time()
+                self.running = job
+
+            ok = False
+            try:
+                self.deploy(job)
+                ok = True
+            except Exception:
+                log.exception(f"{job['action']} to {job['commit']} failed")
+
+            with self.cond:
+                self.running = None
+                job["duration"] = time.time() - job["started"]
+                job["ok"] = ok
+                self.recent.append(job)
+            if ok and not job.get("skipped"):
+                log.info(
+                    f"{job['action']} to {job['commit']} done in {job['duration']:.1f}s"
+                )
+
+
+def payload_paths(req):
+    # Files changed by the pushed commits, or None if the payload doesn't
+    # list all of them. A forced push lists only the new commits, not the
+    # ones it dropped, whose changes are undone too.
+    commits = req.get("commits")
+    if req.get("forced") or not commits or len(commits) >= max_payload_commits:
+        return None
+    paths = set()
+    for commit in commits:
+        for key in ["added", "removed", "modified"]:
+            paths.update(commit.get(key, []))
+    return sorted(paths)
+
+
+def affects_build(paths):
+    for path in paths:
+        for input_ in build_inputs:
+            if path == input_ or (input_.endswith("/") and path.startswith(input_)):
+                return True
+    return False
+
+
+def valid_signature(secret, body, signature):
+    # GitHub's X-Hub-Signature-256 header, an HMAC of the body. Without a
+    # secret nothing is valid.
+    if not secret:
+        return False
+    digest = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"sha256={digest}".encode(), signature.encode())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+from html.parser import HTMLParser
+
+# Every deploy is built into its own directory under releases/ and published
+# from the `live` symlink, which is only ever switched to a release that built
+# and passed the smoke check. Switching is a single rename, so whatever reads
+# through `live` sees either the old release or the new one, never a mix. The
+# site itself is served by GitHub Pages from a gh-pages commit made from
+# `live`, which Pages rolls out on its own schedule. That commit also keeps the
+# hashed files of the other kept releases, so an index.html cached from one of
+# them still finds everything it references.
+releases_dir = "releases"
+live_link = "live"
+# Releases kept around for rolling back, besides the live one
+default_keep = 5
+# Entry points that the smoke check follows the references of
+entry_pages = ["index.html"]
+release_manifest = "manifest.json"
+_commit = re.compile(r"[0-9a-f]{7,40}")
+
+
+def list_releases():
+    # Oldest first, names start with the build time. Releases that are still
+    # being built are hidden.
+    try:
+        names = os.listdir(releases_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        n
+        for n in names
+        if not n.startswith(".") and os.path.isdir(os.path.join(releases_dir, n))
+    )
+
+
+def current():
+    try:
+        return os.path.basename(os.readlink(live_link))
+    except FileNotFoundError:
+        return None
+
+
+class _References(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.paths = []
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if name not in ("src", "href") or not value:
+                continue
+            value = value.split("#", 1)[0].split("?", 1)[0]
+            if not value or "//" in value or value.startswith(("data:", "mailto:")):
+                continue
+            self.paths.append(value)
+
+
+def check(path):
+    # Returns what's wrong with the release in `path`: a missing or empty file
+    # that a page or the hashed file manifest points at
+    errors = []
+    wanted = []
+    for page in entry_pages:
+        try:
+            with open(os.path.join(path, page)) as f:
+                references = _References()
+                references.feed(f.read())
+        except FileNotFoundError:
+            errors.append(f"{page} is missing")
+            continue
+        wanted += [(page, ref) for ref in references.paths]
+    try:
+        with open(os.path.join(path, release_manifest)) as f:
+            wanted += [(release_manifest, h) for h in json.load(f).values()]
+    except FileNotFoundError:
+        pass
+    except ValueError as e:
+        errors.append(f"{release_manifest} is invalid: {e}")
+
+    for referrer, ref in wanted:
+        target = os.path.normpath(os.path.join(path, ref.lstrip("/")))
+        if not os.path.isfile(target):
+            errors.append(f"{ref} from {referrer} is missing")
+        elif not os.path.getsize(target):
+            errors.append(f"{ref} from {referrer} is empty")
+    return errors
+
+
+def hashed_files(name):
+    # The content-hashed files of a release and their compressed siblings,
+    # relative to it
+    path = _release_path(name)
+    try:
+        with open(os.path.join(path, release_manifest)) as f:
+            hashed = list(json.load(f).values())
+    except (FileNotFoundError, ValueError):
+        return []
+    files = []
+    for rel in hashed:
+        for suffix in ["", ".gz", ".br"]:
+            if os.path.isfile(os.path.join(path, rel + suffix)):
+                files.append(rel + suffix)
+    return files
+
+
+def activate(name):
+    # Points `live` at the release atomically
+    _release_path(name)
+    tmp_link = f"{live_link}.tmp"
+    try:
+        os.remove(tmp_link)
+    except FileNotFoundError:
+        pass
+    os.symlink(os.path.join(releases_dir, name), tmp_link)
+    os.replace(tmp_link, live_link)
+    print(f"{live_link} -> {name}")
+
+
+def prune(keep):
+    live = current()
+    old = [n for n in list_releases() if n != live]
+    stale = old[: max(0, len(old) - keep)]
+    # Left behind by builds that failed or were killed
+    stale += [n for n in os.listdir(releases_dir) if n.startswith(".")]
+    for name in stale:
+        shutil.rmtree(_release_path(name), ignore_errors=True)
+    if stale:
+        print(f"Removed {len(stale)} old release(s)")
+
+
+def _release_path(name):
+    # Refuses anything that would end up outside releases/. Paths are refused
+    # even when they resolve back into it, `live` would link to them as is.
+    root = os.path.realpath(releases_dir)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.basename(name) != name or name in ("", ".", ".."):
+        sys.exit(f"Invalid release name {name!r}")
+    if os.path.dirname(path) != root:
+        sys.exit(f"Invalid release name {name!r}")
+    return path
+
+
+def deploy(commit, keep):
+    if not _commit.fullmatch(commit):
+        sys.exit(f"Expected a commit SHA, got {commit!r}")
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{commit[:12]}"
+    os.makedirs(releases_dir, exist_ok=True)
+    staging = _release_path(f".{name}")
+    release = _release_path(name)
+
+    live = current()
+    try:
+        if live:
+            # Start from the live release so that the build stays incremental
+            shutil.copytree(os.path.join(releases_dir, live), staging, symlinks=True)
+        subprocess.check_call(["./build.py", "--release", "--output", staging])
+        errors = check(staging)
+        if errors:
+            for error in errors:
+                print(error)
+            sys.exit(f"{name} failed the smoke check")
+        os.rename(staging, release)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    activate(name)
+    prune(keep)
+
+
+def rollback(name):
+    # To `name`, or the release before the live one
+    names = list_releases()
+    if name is None:
+        live = current()
+        older = names[: names.index(live)] if live in names else []
+        if not older:
+            sys.exit("No release to roll back to")
+        name = older[-1]
+    elif name not in names:
+        sys.exit(f"Unknown release {name}")
+    activate(name)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Build, switch and roll back releases")
+    parser.add_argument("--keep", type=int, default=default_keep)
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    deploy_parser = subparsers.add_parser("deploy", help="build and go live")
+    deploy_parser.add_argument("commit")
+    rollback_parser = subparsers.add_parser("rollback")
+    rollback_parser.add_argument("release", nargs="?")
+    subparsers.add_parser("list")
+    subparsers.add_parser("kept", help="list the releases besides live")
+    hashed_parser = subparsers.add_parser("hashed", help="list hashed files")
+    hashed_parser.add_argument("release")
+    check_parser = subparsers.add_parser("check", help="smoke check a build")
+    check_parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.action == "deploy":
+        deploy(args.commit, args.keep)
+    elif args.action == "rollback":
+        rollback(args.release)
+    elif args.action == "list":
+        live = current()
+        for name in list_releases():
+            print(name + (" (live)" if name == live else ""))
+    elif args.action == "kept":
+        live = current()
+        for name in list_releases():
+            if name != live:
+                print(name)
+    elif args.action == "hashed":
+        for rel in hashed_files(args.release):
+            print(rel)
+    elif args.action == "check":
+        errors = check(args.path)
+        for error in errors:
+            print(error)
+        sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,32 +1,141 @@
 #!/usr/local/bin/python3
+import logging
 import os
+import re
 import subprocess
 
-from flask import Flask, request
+from flask import Flask, jsonify, request
+
+import releases
+from pipeline import DeployQueue, affects_build, payload_paths, valid_signature
 
 app = Flask(__name__)
 
+deploy_branches = ["main"]
+# Owner of the checkout, git runs as it (and deployer.sh switches to it)
+deploy_user = "pi"
+_sha = re.compile(r"[0-9a-f]{40}")
+# Shared with the GitHub webhook. POSTs must carry its signature of the body,
+# without it every one of them is refused.
+webhook_secret = os.environ.get("WEBHOOK_SECRET", "").encode()
+
+
+def signed(req):
+    signature = req.headers.get("X-Hub-Signature-256", "")
+    return valid_signature(webhook_secret, req.get_data(), signature)
+
+
+def as_deploy_user(args):
+    # Objects fetched as root would leave the checkout unusable for the
+    # deploy's `git pull`
+    return ["runuser", "-u", deploy_user, "--"] + args
+
+
+def git_changed_paths(before, after):
+    if not before or not after or set(before) == {"0"}:
+        # New branch, everything changed
+        return None
+    try:
+        subprocess.check_call(as_deploy_user(["git", "fetch", "--quiet", "origin"]))
+        output = subprocess.check_output(
+            as_deploy_user(
+                ["git", "diff", "--name-only", "--end-of-options", before, after]
+            )
+        )
+    except subprocess.CalledProcessError:
+        app.logger.exception(f"Could not diff {before}..{after}")
+        return None
+    return output.decode().split()
+
+
+def deploy(job):
+    if job["action"] == "rollback":
+        env = dict(
+            os.environ, DEPLOY_ACTION="rollback", DEPLOY_RELEASE=job["commit"] or ""
+        )
+        subprocess.check_call(["bash", "webhook/deployer.sh"], env=env)
+        return
+
+    paths = job["paths"]
+    if paths is None:
+        paths = git_changed_paths(job["before"], job["commit"])
+    if paths is not None and not affects_build(paths):
+        app.logger.info(f"Nothing to deploy for {job['commit']}")
+        job["skipped"] = True
+        return
+
+    env = dict(
+        os.environ,
+        DEPLOY_ACTION="deploy",
+        DEPLOY_BRANCH=job["branch"],
+        DEPLOY_COMMIT=job["commit"],
+    )
+    subprocess.check_call(["bash", "webhook/deployer.sh"], env=env)
+
+
+deploys = DeployQueue(deploy)
+
 
 @app.route("/", methods=["POST", "GET"])
 def hook():
     if request.method == "GET":
         return "hello!"
-    else:
-        # Trigger deploy
-        try:
-            req = request.get_json()
-            branch = req["ref"].split("/")[-1]
-            if branch == "main":
-                subprocess.check_call(["bash", "webhook/deployer.sh"])
-        except:
-            pass
+
+    if not signed(request):
+        return ("Bad signature", 403)
+
+    if request.headers.get("X-GitHub-Event") == "ping":
+        return ("", 204)
+
+    req = request.get_json(silent=True)
+    try:
+        branch = req["ref"].split("/")[-1]
+        commit = req["after"]
+        before = req["before"]
+        paths = payload_paths(req)
+    except (TypeError, KeyError, AttributeError):
+        return ("Expected a push event payload", 400)
+    # Both end up in git and deploy commands
+    if not all(isinstance(c, str) and _sha.fullmatch(c) for c in [before, commit]):
+        return ("Expected commit SHAs in before and after", 400)
+
+    if branch not in deploy_branches or set(commit) == {"0"}:
+        # Not deployed, or the branch was deleted
         return ("", 204)
 
+    # Deploys take minutes, respond before the webhook request times out
+    coalesced = deploys.submit(branch, commit, before, paths)
+    return (jsonify({"queued": True, "coalesced": coalesced}), 202)
+
+
+# Signed like GitHub's requests, e.g. for BODY='{"release": "..."}' or '{}':
+# curl -d "$BODY" -H "X-Hub-Signature-256: sha256=$(printf %s "$BODY" |
+#     openssl dgst -sha256 -hmac "$WEBHOOK_SECRET" -r | cut -d' ' -f1)" ...
+@app.route("/rollback", methods=["POST"])
+def rollback():
+    if not signed(request):
+        return ("Bad signature", 403)
+    req = request.get_json(force=True, silent=True) or {}
+    release = req.get("release") if isinstance(req, dict) else None
+    if release is not None and release not in releases.list_releases():
+        return (f"Unknown release {release}", 404)
+    deploys.rollback(release)
+    return (jsonify({"queued": True, "release": release}), 202)
+
+
+@app.route("/status", methods=["GET"])
+def status():
+    return jsonify(deploys.status())
+
 
 if __name__ == "__main__":
     os.chdir(os.path.dirname(__file__))
     os.chdir("..")
 
+    logging.basicConfig(level=logging.INFO)
+    if not webhook_secret:
+        app.logger.warning("WEBHOOK_SECRET isn't set, refusing all POSTs")
+    deploys.start()
     app.run(
         host="0.0.0.0", port=9002,
     )